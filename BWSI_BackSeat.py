@@ -15,15 +15,16 @@ import time
 import datetime
 import traceback
 import getpass
-import utm
 
-from Image_Processor import ImageProcessor
+from Image_Processor import ImageProcessor, VisionPipeline
 from Logger import Logger
 from AUV_Controller import AUVController
 
 from pynmea2 import pynmea2
 import BluefinMessages
-from Sandshark_Interface import SandsharkClient
+from Sandshark_Interface import SandsharkClient, AsyncSandsharkClient
+from BWSI_Projection import make_projection
+from Scheduler import RateScheduler
 
 from Logger import Logger
 
@@ -40,16 +41,39 @@ def checkthesum(msg):
     return True
 
 class BackSeat():
+    # rate of each task in the control loop, in Hz at warp 1
+    DEFAULT_RATES = {'status': 1.0,   # heartbeat to the front seat
+                     'nav': 1.0,      # process navigation messages
+                     'camera': 1.0,   # capture an image and detect buoys
+                     'control': 1.0,  # decide and send a command
+                     }
+    
     # we assign the mission parameters on init
-    def __init__(self, host='localhost', port=8000, warp=1):
+    def __init__(self, host='localhost', port=8000, warp=1, projection='LOCAL',
+                 projection_error=0.001, rates=None, report_interval=10.0,
+                 pipelined_vision=False, vision_rate=24, max_vision_age=1.0,
+                 transport='SOCKET'):
         
-        # back seat acts as client
-        self.__client = SandsharkClient(host=host, port=port)
+        # back seat acts as client; transport 'SOCKET' polls the socket,
+        # 'ASYNC' is event driven on an asyncio loop
+        if transport.upper() == 'ASYNC':
+            self.__client = AsyncSandsharkClient(host=host, port=port)
+        else:
+            self.__client = SandsharkClient(host=host, port=port)
         self.__current_time = datetime.datetime.utcnow().timestamp()
         self.__start_time = self.__current_time
         self.__log_file = f"./logs/backseat_{self.__start_time}.log"
         self.__warp = warp
         
+        # each task runs on a fixed schedule at its rate times warp, and the
+        # scheduler's jitter and overruns are logged every report_interval
+        # seconds
+        self.__rates = dict(self.DEFAULT_RATES)
+        if rates is not None:
+            self.__rates.update(rates)
+        self.__report_interval = report_interval
+        self.__scheduler = RateScheduler()
+        
         self.__auv_state = dict([
             ('position', (None, None)),
             ('latlon', None),
@@ -61,8 +85,16 @@ class BackSeat():
             ('last_fix_time', None)
             ])
         
+        # latest buoy angles from the camera
+        self.__red = list()
+        self.__green = list()
+        
         # we'll use the first navigation update as datum
         self.__datum = None
+        # built with make_projection once the datum is known
+        self.__projection_mode = projection
+        self.__projection_error = projection_error
+        self.__projection = None
         
         # set to PICAM for the real camera
         if True:
@@ -71,6 +103,16 @@ class BackSeat():
             self.__buoy_detector = ImageProcessor(camera='SIM')
         self.__logger = Logger(True)
         self.__autonomy = AUVController()
+        
+        # pipelined: the buoy detector runs on its own thread, at vision_rate
+        # (the camera's frame rate by default, as fast as it can if None),
+        # instead of as the camera task. Control uses its latest detections,
+        # ignoring them once they're older than max_vision_age seconds
+        self.__vision = None
+        if pipelined_vision:
+            self.__vision = VisionPipeline(self.__buoy_detector, rate=vision_rate)
+        self.__max_vision_age = max_vision_age
+        self.__vision_seq = 0
     
     def run(self):
         try:
@@ -83,63 +125,117 @@ class BackSeat():
 
             msg = BluefinMessages.BPLOG('ALL', 'ON')
             self.send_message(msg)
-                        
-            while True:
-                now = datetime.datetime.utcnow().timestamp()
-                delta_time = (now-self.__current_time) * self.__warp
-
-                self.send_status()
-
-                self.__current_time += delta_time
-                
-                msgs = self.get_mail()
-                if len(msgs) > 0:
-                    print("\nReceived from Frontseat:")
-
-                    for msg in msgs:
-                        print(f"{str(msg, 'utf-8')}")
-                        self.process_message(str(msg, 'utf-8'))
-                        print(f"{self.__auv_state}")
-                        
-
-                red, green = self.__buoy_detector.run(self.__auv_state)
-                
-                if len(red) > 0:
-                    self.__logger.log_event("RED",red[0])
-                if len(green) > 0:
-                    self.__logger.log_event("GREEN",green[0])
-                
-                command_str = self.__autonomy.decide(self.__auv_state, green, red, sensor_type='ANGLE').lower()
-                print(f"command_string: {command_str}")
-
-                self.__current_time = datetime.datetime.utcnow().timestamp()
-                if self.__current_time - self.__start_time > 60.0:
-                    hhmmss = datetime.datetime.fromtimestamp(self.__current_time).strftime('%H%M%S.%f')[:-4]
-                    cmd = f"BPRMB,{hhmmss},0,1,0,0,0,1"
-                    msg = f"${cmd}*{hex(BluefinMessages.checksum(cmd))[2:]}\r\n"
-                    self.send_message(msg)
-                elif command_str != "":
-                    heading = 0.0
-                    speed = 0.0
-                    # This is the timestamp format from NMEA: hhmmss.ss
-                    self.__current_time = time.time()
-                    hhmmss = datetime.datetime.fromtimestamp(self.__current_time).strftime('%H%M%S.%f')[:-4]
-                    for command in command_str.split(';'):
-                        args = command.split(' ')
-                        #check if a turn or thrust command
-                        if len(args) == 2 and args[0] == "turn":
-                            heading = float(args[1])
-                        elif len(args) == 2 and args[0] == "thruster":
-                            speed = int(args[1])
-                    cmd = f"BPRMB,{hhmmss},{heading},1,0,{speed},0,1"
-                    msg = f"${cmd}*{hex(BluefinMessages.checksum(cmd))[2:]}\r\n"
-                    self.send_message(msg)
-
-                time.sleep(1/self.__warp)
+            
+            # tasks due together run in this order
+            tasks = [('status', self.send_status),
+                     ('nav', self.__nav_task),
+                     ('camera', self.__camera_task),
+                     ('control', self.__control_task)]
+            if self.__vision is not None:
+                tasks.remove(('camera', self.__camera_task))
+                self.__vision.start()
+            for name, func in tasks:
+                self.__scheduler.add_task(name, func, self.__rates[name] * self.__warp)
+            if self.__report_interval is not None:
+                self.__scheduler.add_task('report', self.__report_task, 1.0 / self.__report_interval)
+            
+            self.__scheduler.run()
         except:
             traceback.print_exc()
+            if self.__vision is not None:
+                self.__vision.stop()
             self.__client.cleanup()
             client.join()
+    
+    # runs, overruns, skipped deadlines, jitter and run time of each task
+    def get_schedule_stats(self):
+        return self.__scheduler.get_stats()
+    
+    def __nav_task(self):
+        msgs = self.get_mail()
+        if len(msgs) > 0:
+            print("\nReceived from Frontseat:")
+
+            for msg in msgs:
+                print(f"{str(msg, 'utf-8')}")
+                self.process_message(str(msg, 'utf-8'))
+                print(f"{self.__auv_state}")
+        
+        if self.__vision is not None:
+            self.__vision.update_state(self.__auv_state)
+    
+    def __camera_task(self):
+        self.__red, self.__green = self.__buoy_detector.run(self.__auv_state)
+        self.__log_buoys()
+    
+    def __log_buoys(self):
+        if len(self.__red) > 0:
+            self.__logger.log_event("RED",self.__red[0])
+        if len(self.__green) > 0:
+            self.__logger.log_event("GREEN",self.__green[0])
+    
+    # pick up the vision pipeline's latest detections
+    def __read_vision(self):
+        detections, capture_time, seq = self.__vision.get_detections()
+        if seq == 0 or time.monotonic() - capture_time > self.__max_vision_age:
+            # nothing recent enough to steer by
+            self.__red, self.__green = list(), list()
+            return
+        
+        self.__red, self.__green = detections
+        if seq != self.__vision_seq:
+            self.__vision_seq = seq
+            self.__log_buoys()
+    
+    def __control_task(self):
+        if self.__vision is not None:
+            self.__read_vision()
+        
+        command_str = self.__autonomy.decide(self.__auv_state, self.__green, self.__red, sensor_type='ANGLE').lower()
+        print(f"command_string: {command_str}")
+
+        self.__current_time = datetime.datetime.utcnow().timestamp()
+        if self.__current_time - self.__start_time > 60.0:
+            hhmmss = datetime.datetime.fromtimestamp(self.__current_time).strftime('%H%M%S.%f')[:-4]
+            cmd = f"BPRMB,{hhmmss},0,1,0,0,0,1"
+            msg = f"${cmd}*{hex(BluefinMessages.checksum(cmd))[2:]}\r\n"
+            self.send_message(msg)
+        elif command_str != "":
+            heading = 0.0
+            speed = 0.0
+            # This is the timestamp format from NMEA: hhmmss.ss
+            self.__current_time = time.time()
+            hhmmss = datetime.datetime.fromtimestamp(self.__current_time).strftime('%H%M%S.%f')[:-4]
+            for command in command_str.split(';'):
+                args = command.split(' ')
+                #check if a turn or thrust command
+                if len(args) == 2 and args[0] == "turn":
+                    heading = float(args[1])
+                elif len(args) == 2 and args[0] == "thruster":
+                    speed = int(args[1])
+            cmd = f"BPRMB,{hhmmss},{heading},1,0,{speed},0,1"
+            msg = f"${cmd}*{hex(BluefinMessages.checksum(cmd))[2:]}\r\n"
+            self.send_message(msg)
+    
+    # end to end latency of timed messages from the front seat (BFNVG), and
+    # how long messages waited in the client to be picked up, per sentence type
+    def get_mail_latency_stats(self):
+        return self.__client.get_latency_stats()
+    
+    def __report_task(self):
+        self.__logger.log_event("SCHEDULER", "\n" + self.__scheduler.report())
+        lines = list()
+        for kind, s in self.get_mail_latency_stats().items():
+            line = f"{kind}: {s['count']} received"
+            if s['latency_mean'] is not None:
+                line += (f", latency mean/p99/max {s['latency_mean']*1e3:.1f}/"
+                         f"{s['latency_p99']*1e3:.1f}/{s['latency_max']*1e3:.1f} ms")
+            if s['queue_wait_mean'] is not None:
+                line += (f", queue wait mean/p99/max {s['queue_wait_mean']*1e3:.1f}/"
+                         f"{s['queue_wait_p99']*1e3:.1f}/{s['queue_wait_max']*1e3:.1f} ms")
+            lines.append(line)
+        if len(lines) > 0:
+            self.__logger.log_event("MAIL", "\n" + '\n'.join(lines))
           
         
     def process_message(self, message):
@@ -182,7 +278,9 @@ class BackSeat():
                 if self.__datum is None:
                     # on first navigation update, set datum
                     self.__datum = self.__auv_state['latlon']
-                    self.__datum_position = utm.from_latlon(self.__datum[0], self.__datum[1])
+                    self.__projection = make_projection(self.__datum,
+                                                        self.__projection_mode,
+                                                        max_error=self.__projection_error)
                     self.__auv_state['position'] = (0, 0)
                 else:
                     self.__auv_state['position'] = self.__get_local_position()
@@ -280,13 +378,8 @@ class BackSeat():
         return (latitude, longitude)
     
     def __get_local_position(self):
-        # check that datum is in the same UTM zone, if not, shift datum
-        local_pos = utm.from_latlon(self.__auv_state['latlon'][0],
-                                    self.__auv_state['latlon'][1],
-                                    force_zone_number=self.__datum_position[2],
-                                    force_zone_letter=self.__datum_position[3])
-        
-        return (local_pos[0]-self.__datum_position[0], local_pos[1]-self.__datum_position[1])
+        return self.__projection.to_local(self.__auv_state['latlon'][0],
+                                          self.__auv_state['latlon'][1])
 
     
     
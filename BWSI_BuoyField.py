@@ -12,16 +12,16 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
-import utm
+from BWSI_Projection import make_projection
 
 ## Utility functions
+# pure float arithmetic, since these are called for every gate on every step
 def corridor_check(A, G, R):
-    GR = np.array((R[0]-G[0], R[1]-G[1]))
-    GA = np.array((A[0]-G[0], A[1]-G[1]))
-    RA = np.array((A[0]-R[0], A[1]-R[1]))
+    GRx = R[0]-G[0]
+    GRy = R[1]-G[1]
     
-    GRGA = np.dot(GR, GA)
-    GRRA = np.dot(GR, RA)
+    GRGA = GRx*(A[0]-G[0]) + GRy*(A[1]-G[1])
+    GRRA = GRx*(A[0]-R[0]) + GRy*(A[1]-R[1])
 
     return (GRGA*GRRA < 0)
 
@@ -30,81 +30,290 @@ def gate_check(B, A, G, R):
     if not (corridor_check(A, G, R) and corridor_check(B, G, R) ):
         return False
     
-    GR = np.array((R[0]-G[0], R[1]-G[1], 0))
-    GA = np.array((A[0]-G[0], A[1]-G[1], 0))
-    GB = np.array((B[0]-G[0], B[1]-G[1], 0))
+    GRx = R[0]-G[0]
+    GRy = R[1]-G[1]
     
-    GRGA = np.cross(GR, GA)
-    GRGB = np.cross(GR, GB)
+    # z components of GR x GA and GR x GB
+    GRGA = GRx*(A[1]-G[1]) - GRy*(A[0]-G[0])
+    GRGB = GRx*(B[1]-G[1]) - GRy*(B[0]-G[0])
     
-    return (GRGA[2]*GRGB[2] < 0)
+    return (GRGA*GRGB < 0)
+
+# broadcasting versions of corridor_check and gate_check, for arrays of
+# points with the x,y coordinates on the last axis
+def corridor_check_array(A, G, R):
+    GR = R - G
+    GRGA = np.sum(GR * (A - G), axis=-1)
+    GRRA = np.sum(GR * (A - R), axis=-1)
+    
+    return (GRGA*GRRA < 0)
+
+def gate_check_array(B, A, G, R):
+    GR = R - G
+    GA = A - G
+    GB = B - G
+    GRGA = GR[...,0]*GA[...,1] - GR[...,1]*GA[...,0]
+    GRGB = GR[...,0]*GB[...,1] - GR[...,1]*GB[...,0]
+    
+    return np.logical_and(np.logical_and(corridor_check_array(A, G, R),
+                                         corridor_check_array(B, G, R)),
+                          GRGA*GRGB < 0)
+
+# find every crossing of the gates (green[i], red[i]) by the track, a (T,2)
+# array of positions. Segments are tested against all gates at once, in chunks
+# of at most max_pairs (segment, gate) pairs to bound memory. Returns the
+# segment and gate index of each crossing, ordered by segment then gate, and
+# the crossing time interpolated from times (the track point index if None)
+def track_gate_crossings(track, green, red, times=None, max_pairs=2**20):
+    track = np.asarray(track, dtype=np.float64).reshape(-1, 2)
+    green = np.asarray(green, dtype=np.float64).reshape(-1, 2)
+    red = np.asarray(red, dtype=np.float64).reshape(-1, 2)
+    if times is None:
+        times = np.arange(track.shape[0], dtype=np.float64)
+    else:
+        times = np.asarray(times, dtype=np.float64)
+    
+    nSegments = max(track.shape[0] - 1, 0)
+    nGates = green.shape[0]
+    segments = list()
+    gates = list()
+    crossing_times = list()
+    if nSegments == 0 or nGates == 0:
+        return (np.empty((0,), dtype=np.int64),
+                np.empty((0,), dtype=np.int64),
+                np.empty((0,), dtype=np.float64))
+    
+    chunk = max(1, int(max_pairs // nGates))
+    G = green[None,:,:]
+    R = red[None,:,:]
+    for start in range(0, nSegments, chunk):
+        stop = min(start + chunk, nSegments)
+        A = track[start:stop,None,:]
+        B = track[start+1:stop+1,None,:]
+        seg, gate = np.nonzero(gate_check_array(B, A, G, R))
+        
+        # fraction of the way along the segment where it crosses the gate line
+        GR = red[gate] - green[gate]
+        GA = track[start+seg] - green[gate]
+        GB = track[start+seg+1] - green[gate]
+        GRGA = GR[:,0]*GA[:,1] - GR[:,1]*GA[:,0]
+        GRGB = GR[:,0]*GB[:,1] - GR[:,1]*GB[:,0]
+        frac = GRGA / (GRGA - GRGB)
+        
+        seg = seg + start
+        segments.append(seg)
+        gates.append(gate)
+        crossing_times.append(times[seg] + frac*(times[seg+1] - times[seg]))
+    
+    return np.concatenate(segments), np.concatenate(gates), np.concatenate(crossing_times)
 
 class Buoy(object):
     def __init__(self,
                  datum,
                  position=[],
-                 latlon=[]):
+                 latlon=[],
+                 projection=None):
                 
         assert (latlon or position) and not (latlon and position), "Buoy.__init__: Must define either latlon or position!"
 
         self.__datum = datum
-        # returns easting, northing, section #, section letter
-        self.__datum_position = utm.from_latlon(self.__datum[0], self.__datum[1])
+        # a BuoyField passes in its own projection, so the datum is only projected once
+        if projection is None:
+            projection = make_projection(self.__datum, 'UTM')
+        self.__projection = projection
         
         
         if not latlon:
             self.__position = position
             
-            # calculate its latlon
-            self.__latlon = utm.to_latlon(self.__position[0] + self.__datum_position[0],
-                                          self.__position[1] + self.__datum_position[1],
-                                          self.__datum_position[2],
-                                          self.__datum_position[3])
+            # its latlon is calculated when first asked for
+            self.__latlon = None
 
         else:
-            self.__latlon = latlon
-            position = utm.from_latlon(self.__latlon[0],
-                                       self.__latlon[1],
-                                       force_zone_number=self.__datum_position[2],
-                                       force_zone_letter=self.__datum_position[3])
-            self.__position = (position[0]-self.__datum_position[0],
-                               position[1]-self.__datum_position[1])
+            self.update_latlon(latlon)
                     
         
     def update_position(self, newpos):
-        postn = (newpos[0], newpos[1], self.__position[2], self.__position[3])
-        self.__position = postn
-        self.__latlon = utm.to_latlon(self.__position[0] + self.__datum_position[0],
-                                      self.__position[1] + self.__datum_position[1],
-                                      self.__datum_position[2],
-                                      self.__datum_position[3])
+        self.__position = (newpos[0], newpos[1])
+        self.__latlon = None
                  
     def update_latlon(self, newlatlon):
         self.__latlon = newlatlon
-        self.__position = utm.from_latlon(self.__latlon[0],
-                                          self.__latlon[1],
-                                          force_zone_numer=self.__datum_position[2],
-                                          force_zone_letter=self.__datum_position[3])
+        self.__position = self.__projection.to_local(self.__latlon[0], self.__latlon[1])
             
     # accessor functions
     def get_position(self):
         return self.__position
     
     def get_latlon(self):
+        if self.__latlon is None:
+            self.__latlon = self.__projection.to_latlon(self.__position[0], self.__position[1])
         return self.__latlon
         
 
+## Uniform grid over buoy positions, so range queries only visit nearby cells
+class BuoyGrid(object):
+    # below this many buoys a brute force check is cheaper than the cell walk
+    MIN_INDEXED = 200
+    
+    def __init__(self, positions, cell_size=25.0):
+        assert cell_size > 0, "BuoyGrid.__init__: cell_size must be positive!"
+        
+        self.__cell_size = float(cell_size)
+        self.__count = positions.shape[0]
+        
+        # sort the buoys by cell, and remember the slice of the sorted order
+        # that falls in each occupied cell. Cells are keyed by their row-major
+        # offset within the bounding box of the occupied cells
+        cells = np.floor(positions / self.__cell_size).astype(np.int64)
+        self.__order = np.lexsort((cells[:,1], cells[:,0]))
+        if self.__count > 0:
+            self.__cell_min = cells.min(axis=0)
+            self.__cell_max = cells.max(axis=0)
+        else:
+            self.__cell_min = np.zeros((2,), dtype=np.int64)
+            self.__cell_max = np.zeros((2,), dtype=np.int64)
+        self.__ny = self.__cell_max[1] - self.__cell_min[1] + 1
+        
+        sorted_cells = cells[self.__order]
+        keys = (sorted_cells[:,0] - self.__cell_min[0]) * self.__ny + (sorted_cells[:,1] - self.__cell_min[1])
+        firsts = np.flatnonzero(np.diff(keys, prepend=-1))
+        self.__keys = keys[firsts]
+        # buoys of the k-th occupied cell are order[bounds[k]:bounds[k+1]]
+        self.__bounds = np.append(firsts, self.__count)
+    
+    # indices (ascending) of the buoys in every cell that overlaps the square
+    # of half-width max_range around position
+    def candidates(self, position, max_range):
+        if self.__count < self.MIN_INDEXED or not np.isfinite(max_range):
+            return np.arange(self.__count)
+        
+        cell = self.__cell_size
+        ix0 = max(int(np.floor((position[0] - max_range) / cell)), int(self.__cell_min[0]))
+        ix1 = min(int(np.floor((position[0] + max_range) / cell)), int(self.__cell_max[0]))
+        iy0 = max(int(np.floor((position[1] - max_range) / cell)), int(self.__cell_min[1]))
+        iy1 = min(int(np.floor((position[1] + max_range) / cell)), int(self.__cell_max[1]))
+        if ix1 < ix0 or iy1 < iy0:
+            return np.empty((0,), dtype=np.int64)
+        
+        # within one column of cells the window is a contiguous run of keys,
+        # and so a contiguous run of the sorted buoys
+        col = (np.arange(ix0, ix1+1) - self.__cell_min[0]) * self.__ny
+        first = np.searchsorted(self.__keys, col + (iy0 - self.__cell_min[1]), side='left')
+        last = np.searchsorted(self.__keys, col + (iy1 - self.__cell_min[1]), side='right')
+        bounds = self.__bounds
+        idx = np.concatenate([self.__order[bounds[f]:bounds[l]] for f, l in zip(first, last)])
+        idx.sort()
+        return idx
+    
+    # candidate (vehicle, buoy index) pairs for M positions at once, grouped by
+    # vehicle and with ascending buoy indices within each vehicle
+    def candidates_batch(self, positions, max_range):
+        nVehicles = positions.shape[0]
+        max_range = np.broadcast_to(np.asarray(max_range, dtype=np.float64), (nVehicles,))
+        if self.__count < self.MIN_INDEXED or not np.all(np.isfinite(max_range)):
+            vehicle = np.repeat(np.arange(nVehicles), self.__count)
+            index = np.tile(np.arange(self.__count), nVehicles)
+            return vehicle, index
+        
+        # window of cells around each vehicle, clipped to the occupied area
+        lo = np.floor((positions - max_range[:,None]) / self.__cell_size).astype(np.int64)
+        hi = np.floor((positions + max_range[:,None]) / self.__cell_size).astype(np.int64)
+        lo = np.maximum(lo, self.__cell_min)
+        hi = np.minimum(hi, self.__cell_max)
+        nx = np.maximum(hi[:,0] - lo[:,0] + 1, 0)
+        empty = hi[:,1] < lo[:,1]
+        nx[empty] = 0
+        
+        # the same column runs as in candidates, for every vehicle
+        vcol, local = self.__expand(nx)
+        col = (lo[vcol,0] + local - self.__cell_min[0]) * self.__ny
+        first = np.searchsorted(self.__keys, col + lo[vcol,1] - self.__cell_min[1], side='left')
+        last = np.searchsorted(self.__keys, col + hi[vcol,1] - self.__cell_min[1], side='right')
+        start = self.__bounds[first]
+        counts = self.__bounds[last] - start
+        
+        # then every buoy in those runs
+        which, local = self.__expand(counts)
+        vehicle = vcol[which]
+        index = self.__order[start[which] + local]
+        
+        order = np.lexsort((index, vehicle))
+        return vehicle[order], index[order]
+    
+    # for run lengths counts, the run each element belongs to and its offset within the run
+    def __expand(self, counts):
+        run = np.repeat(np.arange(counts.size), counts)
+        local = np.arange(run.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        return run, local
+
+
+## Tracks which gates have been passed, keeping a cursor to the next uncleared
+## gate and only checking the gates that can be reached in one step
+class GateTracker(object):
+    def __init__(self, green, red, grid):
+        self.__grid = grid
+        self.__green = green
+        self.__gates = [(float(g[0]), float(g[1]), float(r[0]), float(r[1])) for g, r in zip(green, red)]
+        
+        # a step from A can only cross a gate whose green buoy is within
+        # the step length plus the gate width of A
+        if len(self.__gates) > 0:
+            self.__max_width = float(np.max(np.sqrt(np.sum((red - green)**2, axis=1))))
+        else:
+            self.__max_width = 0.0
+        
+        self.passed = np.zeros((len(self.__gates),), dtype=bool)
+        self.__count = 0
+        self.__cursor = 0
+    
+    def check(self, prev_pos, new_pos):
+        if self.__count == self.passed.size:
+            return
+        
+        reach = np.sqrt((new_pos[0]-prev_pos[0])**2 + (new_pos[1]-prev_pos[1])**2) + self.__max_width
+        window = self.__grid.candidates(prev_pos, reach)
+        window = window[~self.passed[window]]
+        dx = self.__green[window,0] - prev_pos[0]
+        dy = self.__green[window,1] - prev_pos[1]
+        window = window[dx*dx + dy*dy <= reach*reach]
+        for i in window.tolist():
+            gx, gy, rx, ry = self.__gates[i]
+            if gate_check(new_pos, prev_pos, (gx, gy), (rx, ry)):
+                self.passed[i] = True
+                self.__count += 1
+        
+        while self.__cursor < self.passed.size and self.passed[self.__cursor]:
+            self.__cursor += 1
+    
+    # index of the next uncleared gate, None if they are all cleared
+    def next_index(self):
+        if self.__cursor < self.passed.size:
+            return self.__cursor
+        return None
+    
+    def cleared(self):
+        return self.__count
+    
+    def is_clear(self):
+        return self.__count == self.passed.size
+
+
 ## Buoy field class
 class BuoyField(object):
     def __init__(self,
                  datum,
                  green_buoys = [],
                  red_buoys = [],
-                 position_style='P'):
+                 position_style='P',
+                 grid_cell_size=25.0,
+                 projection='LOCAL',
+                 projection_error=0.001):
         
         # position_style = 'P' for position, 'L' for latlon
         self.__datum = datum
-        self.__datum_position = utm.from_latlon(self.__datum[0], self.__datum[1])
+        self.__grid_cell_size = grid_cell_size
+        self.__projection = make_projection(self.__datum, projection, max_error=projection_error)
 
         self.add_buoy_gates(green_buoys, red_buoys, position_style)
         self.__miss_start_time = float('inf')
@@ -298,17 +507,56 @@ class BuoyField(object):
         
         assert len(green) == len(red), "Should be equal number of green and red buoys"
         assert position_style=='P' or position_style=='L', f"Unknown position style {position_style}"
+        if position_style == 'P':
+            green_pos = green
+            red_pos = red
+            # latlons are only calculated when asked for
+            self.__green_latlon = None
+            self.__red_latlon = None
+        else:
+            # convert all the latlons in one go
+            self.__green_latlon = np.asarray(green, dtype=np.float64).reshape(-1, 2)
+            self.__red_latlon = np.asarray(red, dtype=np.float64).reshape(-1, 2)
+            green_pos = [tuple(p) for p in self.__latlon_to_local(self.__green_latlon).tolist()]
+            red_pos = [tuple(p) for p in self.__latlon_to_local(self.__red_latlon).tolist()]
+            
         self.__green_buoys = list()
         self.__red_buoys = list()
         for i in range(len(green)):
-            if position_style == 'P':
-                self.__green_buoys.append(Buoy(self.__datum, position=green[i]))
-                self.__red_buoys.append(Buoy(self.__datum, position=red[i]))
-            else:
-                self.__green_buoys.append(Buoy(self.__datum, latlon=green[i]))
-                self.__red_buoys.append(Buoy(self.__datum, latlon=red[i]))
+            self.__green_buoys.append(Buoy(self.__datum, position=green_pos[i], projection=self.__projection))
+            self.__red_buoys.append(Buoy(self.__datum, position=red_pos[i], projection=self.__projection))
+
+        # contiguous (N,2) arrays of local positions for vectorized queries
+        self.__green_array = self.__position_array(self.__green_buoys)
+        self.__red_array = self.__position_array(self.__red_buoys)
+        
+        # spatial index so range-limited queries skip far away buoys
+        self.__green_grid = BuoyGrid(self.__green_array, self.__grid_cell_size)
+        self.__red_grid = BuoyGrid(self.__red_array, self.__grid_cell_size)
 
-        self.gates_passed = np.zeros( (len(red),), dtype=bool)
+        self.__tracker = GateTracker(self.__green_array, self.__red_array, self.__green_grid)
+        self.gates_passed = self.__tracker.passed
+
+    # bulk conversion between (N,2) arrays of latlon and of local position
+    def __latlon_to_local(self, latlon):
+        local = np.empty(latlon.shape, dtype=np.float64)
+        if latlon.shape[0] > 0:
+            local[:,0], local[:,1] = self.__projection.to_local(latlon[:,0], latlon[:,1])
+        return local
+    
+    def __local_to_latlon(self, local):
+        latlon = np.empty(local.shape, dtype=np.float64)
+        if local.shape[0] > 0:
+            latlon[:,0], latlon[:,1] = self.__projection.to_latlon(local[:,0], local[:,1])
+        return latlon
+    
+    def __position_array(self, buoys):
+        arr = np.empty((len(buoys), 2), dtype=np.float64)
+        for i, buoy in enumerate(buoys):
+            pos = buoy.get_position()
+            arr[i, 0] = pos[0]
+            arr[i, 1] = pos[1]
+        return arr
         
     def minimum_distance(self, pos):
         G, R = self.get_buoy_positions()
@@ -336,30 +584,61 @@ class BuoyField(object):
         return (G,R)
     
     def get_buoy_latlon(self):
-        G = list()
-        R = list()
-        for green in self.__green_buoys:
-            G.append(green.get_latlon())
-        for red in self.__red_buoys:
-            R.append(red.get_latlon())
+        if self.__green_latlon is None:
+            self.__green_latlon = self.__local_to_latlon(self.__green_array)
+            self.__red_latlon = self.__local_to_latlon(self.__red_array)
+            
+        G = [tuple(latlon) for latlon in self.__green_latlon.tolist()]
+        R = [tuple(latlon) for latlon in self.__red_latlon.tolist()]
         return (G,R)
         
         
     def check_buoy_gates(self, prev_pos, new_pos):
-        
-        for i in range(self.gates_passed.size):
-            if (self.gates_passed[i] == False):
-                self.gates_passed[i] = gate_check(new_pos, 
-                                                  prev_pos, 
-                                                  self.__green_buoys[i].get_position(),
-                                                  self.__red_buoys[i].get_position())
+        self.__tracker.check(prev_pos, new_pos)
                             
     def clearedBuoys(self):
-        return np.count_nonzero(self.gates_passed)
+        return self.__tracker.cleared()
     
     def isClear(self):
-        return (np.count_nonzero(self.gates_passed) == self.gates_passed.size)
+        return self.__tracker.is_clear()
         
+    # score a whole logged track at once: returns the segment index, gate index
+    # and time of every gate crossing, see track_gate_crossings
+    def track_crossings(self, track, times=None, max_pairs=2**20):
+        return track_gate_crossings(track, self.__green_array, self.__red_array, times, max_pairs)
+        
+    # return the (N,2) arrays of green and red buoy positions
+    def get_buoy_arrays(self):
+        return self.__green_array, self.__red_array
+
+    # vectorized range and bearing from position to every buoy in the field.
+    # Returns (rng, angl, mask) for the green and for the red buoys, where mask
+    # flags the buoys within max_range and between angle_left and angle_right
+    def query_buoys(self,
+                    position,
+                    max_range=float('inf'),
+                    angle_left=0.0,
+                    angle_right=360.0):
+        G = self.__query_array(self.__green_array, position, max_range, angle_left, angle_right)
+        R = self.__query_array(self.__red_array, position, max_range, angle_left, angle_right)
+        return G, R
+
+    def __query_array(self, buoys, position, max_range, angle_left, angle_right):
+        dx = buoys[:,0] - position[0]
+        dy = buoys[:,1] - position[1]
+        rng = np.sqrt(dx*dx + dy*dy)
+        # atan2 returns -pi:pi
+        angl = np.mod(np.degrees(np.arctan2(dx, dy)), 360)
+
+        # note: angle_left and angle_right are mod 360
+        if (angle_left < angle_right):
+            in_view = np.logical_and(angl >= angle_left, angl <= angle_right)
+        else:
+            in_view = np.logical_or(angl >= angle_left, angl <= angle_right)
+
+        mask = np.logical_and(rng < max_range, in_view)
+        return rng, angl, mask
+
     # return all the buoys in the field that are within max_range of the platform,
     # and between angle_left and angle_right (in absolute bearing)
     def detectable_buoys(self,
@@ -367,74 +646,84 @@ class BuoyField(object):
                          max_range,
                          angle_left,
                          angle_right,
-                         sensor_type='POSITION'):
-        # note: angle_left and angle_right are mod 360
-        G = list()
-        for green in self.__green_buoys:
-            gpos = green.get_position()
-            rng = np.sqrt( (position[0]-gpos[0])**2 + (position[1]-gpos[1])**2 )
-            if rng < max_range:
-                # now check if it's within the angle range atan2 returns -pi:pi
-                angl = np.mod(np.degrees(np.arctan2(gpos[0]-position[0], gpos[1]-position[1]) ), 360)
-                if (angle_left < angle_right):
-                    if ( angl >= angle_left and angl <= angle_right ):
-                        if sensor_type == 'POSITION':
-                            G.append(green)
-                        elif sensor_type == 'RANGE_ANGLE':
-                            G.append((rng, angl))
-                        elif sensor_type == 'ANGLE':
-                            G.append(angl)
-                        elif sensor_type == 'RANGE':
-                            G.append(rng)
-                        else:
-                            sys.exit()
-                else:
-                    if ( angl >= angle_left or angl <= angle_right):
-                        if sensor_type == 'POSITION':
-                            G.append(green)
-                        elif sensor_type == 'RANGE_ANGLE':
-                            G.append((rng, angl))
-                        elif sensor_type == 'ANGLE':
-                            G.append(angl)
-                        elif sensor_type == 'RANGE':
-                            G.append(rng)
-                        else:
-                            sys.exit()
-                    
-        R = list()
-        for red in self.__red_buoys:
-            rpos = red.get_position()
-            rng = np.sqrt( (position[0]-rpos[0])**2 + (position[1]-rpos[1])**2 )
-            if rng < max_range:
-                # now check if it's within the angle range atan2 returns -pi:pi
-                angl = np.mod(np.degrees(np.arctan2(rpos[0]-position[0], rpos[1]-position[1]) ), 360)
-                if (angle_left < angle_right):
-                    if (angl >= angle_left and angl <= angle_right):
-                        if sensor_type == 'POSITION':
-                            R.append(red)
-                        elif sensor_type == 'RANGE_ANGLE':
-                            R.append((rng, angl))
-                        elif sensor_type == 'ANGLE':
-                            R.append(angl)
-                        elif sensor_type == 'RANGE':
-                            R.append(rng)
-                        else:
-                            sys.exit()
-                else:
-                    if (angl >= angle_left or angl <= angle_right):
-                        if sensor_type == 'POSITION':
-                            R.append(red)
-                        elif sensor_type == 'RANGE_ANGLE':
-                            R.append((rng, angl))
-                        elif sensor_type == 'ANGLE':
-                            R.append(angl)
-                        elif sensor_type == 'RANGE':
-                            R.append(rng)
-                        else:
-                            sys.exit()
-        
+                         sensor_type='POSITION',
+                         use_index=True):
+        if use_index:
+            # only look at the buoys in grid cells within max_range
+            gidx = self.__green_grid.candidates(position, max_range)
+            ridx = self.__red_grid.candidates(position, max_range)
+        else:
+            gidx = np.arange(self.__green_array.shape[0])
+            ridx = np.arange(self.__red_array.shape[0])
+            
+        Gq = self.__query_array(self.__green_array[gidx], position, max_range, angle_left, angle_right)
+        Rq = self.__query_array(self.__red_array[ridx], position, max_range, angle_left, angle_right)
+        G = self.__detections(self.__green_buoys, gidx, Gq, sensor_type)
+        R = self.__detections(self.__red_buoys, ridx, Rq, sensor_type)
         return G, R
-        
+
+    # format the buoys flagged by a query for the requested sensor type.
+    # candidates maps the query results back to indices in buoys
+    def __detections(self, buoys, candidates, query, sensor_type):
+        rng, angl, mask = query
+        found = np.flatnonzero(mask)
+        idx = candidates[found]
+        if idx.size == 0:
+            return list()
+
+        if sensor_type == 'POSITION':
+            return [buoys[i] for i in idx]
+        elif sensor_type == 'RANGE_ANGLE':
+            return list(zip(rng[found], angl[found]))
+        elif sensor_type == 'ANGLE':
+            return list(angl[found])
+        elif sensor_type == 'RANGE':
+            return list(rng[found])
+        else:
+            sys.exit()
+
+    # detectable buoys for a fleet of M vehicles in one vectorized call.
+    # positions is (M,2); headings, max_angle (half field of view, degrees) and
+    # max_range may be scalars or length M. For each color returns
+    # (offsets, index, rng, angl): vehicle k sees the buoys index[offsets[k]:offsets[k+1]],
+    # at ranges rng[...] and absolute bearings angl[...] over the same slice
+    def detectable_buoys_batch(self,
+                               positions,
+                               headings,
+                               max_angle,
+                               max_range):
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        nVehicles = positions.shape[0]
+        headings = np.broadcast_to(np.asarray(headings, dtype=np.float64), (nVehicles,))
+        max_angle = np.broadcast_to(np.asarray(max_angle, dtype=np.float64), (nVehicles,))
+        max_range = np.broadcast_to(np.asarray(max_range, dtype=np.float64), (nVehicles,))
+
+        G = self.__batch_query(self.__green_array, self.__green_grid,
+                               positions, headings, max_angle, max_range)
+        R = self.__batch_query(self.__red_array, self.__red_grid,
+                               positions, headings, max_angle, max_range)
+        return G, R
+
+    def __batch_query(self, buoys, grid, positions, headings, max_angle, max_range):
+        nVehicles = positions.shape[0]
+
+        # (vehicle, buoy) candidate pairs from the spatial index
+        vehicle, index = grid.candidates_batch(positions, max_range)
+
+        dx = buoys[index,0] - positions[vehicle,0]
+        dy = buoys[index,1] - positions[vehicle,1]
+        rng = np.sqrt(dx*dx + dy*dy)
+        angl = np.mod(np.degrees(np.arctan2(dx, dy)), 360)
+
+        # bearing relative to each vehicle's heading, in -180:180
+        relative = np.mod(angl - headings[vehicle] + 180, 360) - 180
+        mask = np.logical_and(rng < max_range[vehicle],
+                              np.abs(relative) <= max_angle[vehicle])
+
+        offsets = np.zeros((nVehicles+1,), dtype=np.int64)
+        np.cumsum(np.bincount(vehicle[mask], minlength=nVehicles), out=offsets[1:])
+        return offsets, index[mask], rng[mask], angl[mask]
+
     def show_field(self):
         fig = plt.figure()
         #ax = fig.add_subplot(111)
@@ -482,10 +771,9 @@ class BuoyField(object):
         
     # return the position of the next uncleared gate
     def next_gate(self):
-        
-        for i in range(self.gates_passed.size):
-            if (self.gates_passed[i] == False):
-                return self.__green_buoys[i].get_position(), self.__red_buoys[i].get_position()
+        i = self.__tracker.next_index()
+        if i is not None:
+            return self.__green_buoys[i].get_position(), self.__red_buoys[i].get_position()
         
         # if they're all passed
         return None, None
@@ -512,7 +800,4 @@ class BuoyField(object):
 
     ## return if all the gates are cleared        
     def all_gates_cleared(self):
-        if all(self.gates_passed == True):
-            return True
-        else:
-            return False
\ No newline at end of file
+        return self.__tracker.is_clear()
\ No newline at end of file
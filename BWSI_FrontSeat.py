@@ -12,7 +12,7 @@ import sys
 
 from BWSI_Sandshark import Sandshark
 from BWSI_BuoyField import BuoyField
-from Sandshark_Interface import SandsharkServer
+from Sandshark_Interface import SandsharkServer, AsyncSandsharkServer
 
 import threading
 
@@ -24,7 +24,7 @@ import matplotlib.pyplot as plt
 
 class FrontSeat():
     # we assign the mission parameters on init
-    def __init__(self, port=8000, warp=1):
+    def __init__(self, port=8000, warp=1, transport='SOCKET'):
         # start up the vehicle, in setpoint mode
         self.__datum = (42.3, -71.1)
         self.__vehicle = Sandshark(latlon=self.__datum,
@@ -36,8 +36,12 @@ class FrontSeat():
                                    engine_direction='AHEAD',
                                    datum=self.__datum)
         
-        # front seat acts as server
-        self.__server = SandsharkServer(port=port)
+        # front seat acts as server; transport 'SOCKET' polls with select,
+        # 'ASYNC' is event driven on an asyncio loop
+        if transport.upper() == 'ASYNC':
+            self.__server = AsyncSandsharkServer(port=port)
+        else:
+            self.__server = SandsharkServer(port=port)
         self.__current_time = datetime.datetime.utcnow().timestamp()
         self.__start_time = self.__current_time
         self.__warp = warp
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Conversions between latitude/longitude and local (x, y) = (east, north)
+positions in meters relative to a datum.
+
+UTMProjection is exact: local positions are UTM coordinates in the datum's
+zone, offset by the datum's UTM coordinates. LocalProjection approximates the
+same local frame with a quadratic fit around the datum, which costs a handful
+of multiplies instead of a full UTM projection, and falls back to the exact
+projection for points too far from the datum to stay within max_error.
+
+@author: BWSI AUV Challenge Instructional Staff
+"""
+
+import numpy as np
+
+import utm
+
+# build a projection around datum. mode is 'UTM' for the exact projection, or
+# 'LOCAL' for the fast local approximation, within max_error meters of it (the
+# projection_error of the classes that build one). Either way local positions
+# stay in the datum's UTM zone, even once the vehicle has left it
+def make_projection(datum, mode='LOCAL', max_error=0.001):
+    if mode.upper() == 'UTM':
+        return UTMProjection(datum)
+    elif mode.upper() == 'LOCAL':
+        return LocalProjection(datum, max_error=max_error)
+    else:
+        raise ValueError(f"Unknown projection mode {mode}")
+
+
+class UTMProjection(object):
+    def __init__(self, datum):
+        self.__datum = datum
+        # returns easting, northing, section #, section letter
+        self.__datum_position = utm.from_latlon(self.__datum[0], self.__datum[1])
+
+    def get_datum(self):
+        return self.__datum
+
+    def get_datum_position(self):
+        return self.__datum_position
+
+    # lat, lon may be scalars or arrays
+    def to_local(self, lat, lon):
+        easting, northing, _, _ = utm.from_latlon(lat,
+                                                  lon,
+                                                  force_zone_number=self.__datum_position[2],
+                                                  force_zone_letter=self.__datum_position[3])
+        return (easting - self.__datum_position[0], northing - self.__datum_position[1])
+
+    # x, y may be scalars or arrays
+    def to_latlon(self, x, y):
+        return utm.to_latlon(x + self.__datum_position[0],
+                             y + self.__datum_position[1],
+                             self.__datum_position[2],
+                             self.__datum_position[3])
+
+
+class LocalProjection(object):
+    def __init__(self, datum, max_error=0.001, fit_range=2000.0):
+        self.__utm = UTMProjection(datum)
+        self.__lat0 = float(datum[0])
+        self.__lon0 = float(datum[1])
+        self.__max_error = max_error
+
+        # rough meters per degree, only used to lay out the sample points
+        self.__m_per_deg_lat = 111320.0
+        self.__m_per_deg_lon = 111320.0 * max(np.cos(np.radians(self.__lat0)), 1e-6)
+
+        # fit both directions to the exact projection on a grid around the datum
+        grid = np.linspace(-fit_range, fit_range, 21)
+        gx, gy = np.meshgrid(grid, grid)
+        lat, lon = self.__sample_latlon(gx.ravel(), gy.ravel())
+        x, y = self.__utm.to_local(lat, lon)
+        self.__fwd_x = self.__fit(lat - self.__lat0, lon - self.__lon0, x)
+        self.__fwd_y = self.__fit(lat - self.__lat0, lon - self.__lon0, y)
+        self.__inv_lat = self.__fit(x, y, lat - self.__lat0)
+        self.__inv_lon = self.__fit(x, y, lon - self.__lon0)
+
+        # how far from the datum the fit stays within max_error
+        self.__max_range = self.__valid_range(fit_range)
+        self.__max_range2 = self.__max_range**2
+
+    def get_datum(self):
+        return self.__utm.get_datum()
+
+    def get_datum_position(self):
+        return self.__utm.get_datum_position()
+
+    # distance from the datum (meters) within which the fast path is used
+    def get_max_range(self):
+        return self.__max_range
+
+    # lat, lon may be scalars or arrays
+    def to_local(self, lat, lon):
+        if isinstance(lat, float) and isinstance(lon, float):
+            # one position at a time, e.g. every step of the vehicle: plain
+            # float arithmetic, without the array handling
+            u = lat - self.__lat0
+            v = lon - self.__lon0
+            a, b, c, d, e = self.__fwd_x
+            x = float(a*u + b*v + c*u*u + d*u*v + e*v*v)
+            a, b, c, d, e = self.__fwd_y
+            y = float(a*u + b*v + c*u*u + d*u*v + e*v*v)
+            if x*x + y*y > self.__max_range2:
+                return self.__utm.to_local(lat, lon)
+            return (x, y)
+
+        if np.ndim(lat) > 0 or np.ndim(lon) > 0:
+            lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64),
+                                           np.asarray(lon, dtype=np.float64))
+        u = lat - self.__lat0
+        v = lon - self.__lon0
+        x = self.__poly(self.__fwd_x, u, v)
+        y = self.__poly(self.__fwd_y, u, v)
+
+        if np.ndim(x) == 0:
+            if x*x + y*y > self.__max_range2:
+                return self.__utm.to_local(lat, lon)
+            return (x, y)
+
+        far = x*x + y*y > self.__max_range2
+        if np.any(far):
+            x[far], y[far] = self.__utm.to_local(lat[far], lon[far])
+        return (x, y)
+
+    # x, y may be scalars or arrays
+    def to_latlon(self, x, y):
+        if isinstance(x, float) and isinstance(y, float):
+            # as in to_local
+            if x*x + y*y > self.__max_range2:
+                return self.__utm.to_latlon(x, y)
+            a, b, c, d, e = self.__inv_lat
+            lat = float(self.__lat0 + a*x + b*y + c*x*x + d*x*y + e*y*y)
+            a, b, c, d, e = self.__inv_lon
+            lon = float(self.__lon0 + a*x + b*y + c*x*x + d*x*y + e*y*y)
+            return (lat, lon)
+
+        if np.ndim(x) > 0 or np.ndim(y) > 0:
+            x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+                                       np.asarray(y, dtype=np.float64))
+
+        if np.ndim(x) == 0:
+            if x*x + y*y > self.__max_range2:
+                return self.__utm.to_latlon(x, y)
+            return (self.__lat0 + self.__poly(self.__inv_lat, x, y),
+                    self.__lon0 + self.__poly(self.__inv_lon, x, y))
+
+        lat = self.__lat0 + self.__poly(self.__inv_lat, x, y)
+        lon = self.__lon0 + self.__poly(self.__inv_lon, x, y)
+        far = x*x + y*y > self.__max_range2
+        if np.any(far):
+            lat[far], lon[far] = self.__utm.to_latlon(x[far], y[far])
+        return (lat, lon)
+
+    # quadratic in (u, v) with no constant term, as the datum maps to itself
+    def __poly(self, c, u, v):
+        return c[0]*u + c[1]*v + c[2]*u*u + c[3]*u*v + c[4]*v*v
+
+    def __fit(self, u, v, target):
+        basis = np.stack((u, v, u*u, u*v, v*v), axis=-1)
+        coeffs = np.linalg.lstsq(basis, target, rcond=None)[0]
+        return [float(c) for c in coeffs]
+
+    def __sample_latlon(self, x, y):
+        return (self.__lat0 + y / self.__m_per_deg_lat,
+                self.__lon0 + x / self.__m_per_deg_lon)
+
+    # largest radius, in doubling steps, out to which the fit in both directions
+    # is within max_error on rings of sample points around the datum
+    def __valid_range(self, fit_range):
+        theta = np.linspace(0, 2*np.pi, 64, endpoint=False)
+        valid = 0.0
+        for radius in fit_range * 2.0**np.arange(-8, 5):
+            lat, lon = self.__sample_latlon(radius*np.sin(theta), radius*np.cos(theta))
+            try:
+                x, y = self.__utm.to_local(lat, lon)
+                ax = self.__poly(self.__fwd_x, lat - self.__lat0, lon - self.__lon0)
+                ay = self.__poly(self.__fwd_y, lat - self.__lat0, lon - self.__lon0)
+                fwd_error = np.max(np.sqrt((ax-x)**2 + (ay-y)**2))
+
+                # inverse error measured in meters, through the exact projection
+                ix, iy = self.__utm.to_local(self.__lat0 + self.__poly(self.__inv_lat, x, y),
+                                             self.__lon0 + self.__poly(self.__inv_lon, x, y))
+                inv_error = np.max(np.sqrt((ix-x)**2 + (iy-y)**2))
+            except utm.OutOfRangeError:
+                break
+
+            if max(fwd_error, inv_error) > self.__max_error:
+                break
+            valid = radius
+
+        return valid
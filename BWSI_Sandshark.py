@@ -5,7 +5,6 @@ Created on Thu Mar  4 20:23:11 2021
 @author: BWSI AUV Challenge Instructional Staff
 """
 import numpy as np
-import utm
 import random
 import time
 import datetime
@@ -14,6 +13,7 @@ import pytz
 
 from pynmea2 import pynmea2
 import BluefinMessages
+from BWSI_Projection import make_projection
 
 def nmea_lat(lat_deg):
     val = np.abs(lat_deg)
@@ -42,7 +42,9 @@ class Sandshark(object):
                  engine_speed='STOP',
                  engine_direction='AHEAD',
                  visibility=100,
-                 datum=(0.0,0.0)):
+                 datum=(0.0,0.0),
+                 projection='LOCAL',
+                 projection_error=0.001):
 
         ####
         ## state components that we control
@@ -86,7 +88,7 @@ class Sandshark(object):
         ######################################
         ## external information and parameters
         self.__datum = datum
-        self.__datum_position = utm.from_latlon(self.__datum[0], self.__datum[1])
+        self.__projection = make_projection(self.__datum, projection, max_error=projection_error)
         self.__position = self.__get_local_position()
 
         ## characteristic of vehicle; should be overwritten by a subclass
@@ -118,10 +120,7 @@ class Sandshark(object):
         x = self.__position[0] + dx
         y = self.__position[1] + dy
         self.__position = (x,y)
-        self.__latlon = utm.to_latlon(self.__position[0] + self.__datum_position[0],
-                                      self.__position[1] + self.__datum_position[1],
-                                      self.__datum_position[2],
-                                      self.__datum_position[3])
+        self.__latlon = self.__projection.to_latlon(self.__position[0], self.__position[1])
         
         # battery usage
         self.__battery = self.__battery - np.sqrt(dx**2 + dy**2)
@@ -414,16 +413,10 @@ class Sandshark(object):
         return reply_string
     
     def __get_local_position(self):
-        # check that datum is in the same UTM zone, if not, shift datum
-        local_pos = utm.from_latlon(self.__latlon[0],
-                                    self.__latlon[1],
-                                    force_zone_number=self.__datum_position[2],
-                                    force_zone_letter=self.__datum_position[3])
-        
-        return (local_pos[0]-self.__datum_position[0], local_pos[1]-self.__datum_position[1])
+        return self.__projection.to_local(self.__latlon[0], self.__latlon[1])
     
     def __update_latlon(self):
-        self.__latlon = utm.to_latlon(self.__position + self.__datum_position)
+        self.__latlon = self.__projection.to_latlon(self.__position[0], self.__position[1])
         
     def __rudder_hydro_effect(self):
         for count, pos in enumerate(self.__rudder_history):
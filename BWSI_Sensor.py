@@ -5,6 +5,11 @@ Created on Sat Apr  3 19:49:45 2021
 @author: BWSI AUV Challenge Instructional Staff
 """
 import sys
+import os
+import pathlib
+import tempfile
+import collections
+import multiprocessing
 
 import numpy as np
 import cv2
@@ -12,15 +17,89 @@ import cv2
 import BWSI_BuoyField
 import matplotlib.pyplot as plt
 
+# buoy images, loaded once per process and shared by all cameras
+_BUOY_IMAGE_FILES = {'red': 'red_buoy_pool_img.jpg',
+                     'green': 'green_buoy_pool_img.jpg'}
+_buoy_images = dict()
+
+# return the RGB image of a buoy color, loading it from data/ on first use
+def buoy_image(color):
+    color = color.lower()
+    if color not in _buoy_images:
+        fn = pathlib.Path(__file__).parent / 'data' / _BUOY_IMAGE_FILES[color]
+        img = cv2.imread(str(fn))
+        if img is None:
+            raise IOError(f"Could not read buoy image {fn}")
+        _buoy_images[color] = np.ascontiguousarray(np.flip(img, axis=2))
+    return _buoy_images[color]
+
+def load_buoy_images():
+    for color in _BUOY_IMAGE_FILES:
+        buoy_image(color)
+
+
+## LRU cache of buoy images resized to a given output width in pixels,
+## bounded by the total bytes of the cached images
+class SpriteCache(object):
+    def __init__(self, max_bytes=32*1024*1024):
+        self.__max_bytes = max_bytes
+        self.__bytes = 0
+        self.__sprites = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    # the buoy image scaled to width pixels across (keeping its aspect ratio),
+    # or None if that rounds down to no rows
+    def get(self, color, width):
+        key = (color, width)
+        sprite = self.__sprites.get(key)
+        if sprite is not None:
+            self.__sprites.move_to_end(key)
+            self.hits += 1
+            return sprite
+        
+        self.misses += 1
+        img = buoy_image(color)
+        pix_y, pix_x, nchan = img.shape
+        mult = width / pix_x
+        height = int(mult * pix_y)
+        if width <= 0 or height <= 0:
+            return None
+        sprite = cv2.resize(img, (width, height))
+        
+        if sprite.nbytes <= self.__max_bytes:
+            self.__sprites[key] = sprite
+            self.__bytes += sprite.nbytes
+            while self.__bytes > self.__max_bytes:
+                _, old = self.__sprites.popitem(last=False)
+                self.__bytes -= old.nbytes
+        return sprite
+    
+    def get_bytes(self):
+        return self.__bytes
+    
+    def clear(self):
+        self.__sprites.clear()
+        self.__bytes = 0
+
+_sprite_cache = SpriteCache()
+
+
 class BWSI_Camera(object):
-    def __init__(self, max_angle=90, visibility=100):
+    # rows, columns, channels of every frame
+    FRAME_SHAPE = (480, 640, 3)
+    
+    # noise = 'GENERATOR' draws fresh noise every frame, 'BANK' adds a random
+    # slice of a precomputed bank of noise frames (faster, but the noise
+    # repeats over a long run), and 'LEGACY' reproduces the original float64
+    # np.random.normal path
+    def __init__(self, max_angle=90, visibility=100, noise='GENERATOR', seed=None, noise_bank_size=8):
         self.__MAX_RANGE = visibility # maximum range camera can see
         self.__MAX_ANGLE = max_angle # field of view of camera (+/- MAX_ANGLE degrees)
         self.__SENSOR_TYPE = 'ANGLE'
         
         # Parameters relevant for simulating camera images
-        self.__Wpix = 640
-        self.__Hpix = 480
+        self.__Hpix, self.__Wpix, _ = self.FRAME_SHAPE
         self.__max_angle_W = 31.1
         self.__max_angle_H = 24.4
     
@@ -42,8 +121,25 @@ class BWSI_Camera(object):
         self.__image_mat[:,:,2].fill(background[2])
         
         self.image_snap = None
-        self.__buoy_image_green = None
-        self.__buoy_image_red = None
+        
+        # buoy images are shared across cameras in this process
+        load_buoy_images()
+        self.__sprites = _sprite_cache
+        
+        # image noise, and reusable buffers so that frames don't allocate temporaries
+        self.__noise_mode = noise.upper()
+        assert self.__noise_mode in ('BANK', 'GENERATOR', 'LEGACY'), f"Unknown noise mode {noise}"
+        self.__noise_std = 20
+        self.__rng = np.random.default_rng(seed)
+        self.__scratch = np.empty_like(self.__image_mat)
+        self.__noisy = np.empty((self.__Hpix, self.__Wpix, 3), dtype=np.int16)
+        if self.__noise_mode == 'BANK':
+            nvals = self.__noisy.size
+            bank = self.__rng.standard_normal((noise_bank_size, nvals), dtype=np.float32)
+            bank *= self.__noise_std
+            self.__noise_bank = bank.astype(np.int16)
+        elif self.__noise_mode == 'GENERATOR':
+            self.__noise_f32 = np.empty(self.__noisy.shape, dtype=np.float32)
 
         
     def get_visible_buoys(self, pos, hdg, buoy_field):
@@ -71,10 +167,17 @@ class BWSI_Camera(object):
                 
         return G, R
     
-    def get_frame(self, pos, hdg, buoy_field):
+    # synthesize a BGR uint8 camera frame (int64 in LEGACY noise mode). If out is
+    # given, the frame is written into it instead of a new array
+    def get_frame(self, pos, hdg, buoy_field, out=None):
         G, R = self.get_visible_buoys_with_range(pos, hdg, buoy_field)
         print(f"{len(G)}, {len(R)}")
-        image_snap = self.__image_mat.copy()
+        if self.__noise_mode == 'LEGACY':
+            image_snap = self.__image_mat.copy()
+        else:
+            image_snap = self.__scratch
+            np.copyto(image_snap, self.__image_mat)
+            
         for g in G:
             buoy_range, true_heading = g
             relative_heading = true_heading - hdg
@@ -95,6 +198,9 @@ class BWSI_Camera(object):
             # print(f"buoy_range = {buoy_range}")
             image_snap = self.add_buoy_image_to_image(image_snap, buoy_range, relative_heading, elev, 'red')
         
+        if self.__noise_mode != 'LEGACY':
+            return self.__add_noise(image_snap, out)
+        
         image_snap = image_snap + np.random.normal(0, 20, (self.__Hpix, self.__Wpix, 3)).astype(int)
         #image_snap[:,:,0] = image_snap[:,:,0] + np.random.normal(0, np.sqrt(3.6), (self.__Hpix, self.__Wpix)).astype(int)
         #image_snap[:,:,1] = image_snap[:,:,1] + np.random.normal(0, np.sqrt(1247.9), (self.__Hpix, self.__Wpix)).astype(int)
@@ -104,62 +210,94 @@ class BWSI_Camera(object):
         
         # make it BGR since we're working with cv2
         image_snap = np.flip(image_snap, axis=2)
-           
+        
+        if out is not None:
+            np.copyto(out, image_snap, casting='unsafe')
+            return out
         return image_snap
+    
+    # add noise to the RGB image_snap with saturation, writing BGR into out
+    def __add_noise(self, image_snap, out):
+        if out is None:
+            out = np.empty(image_snap.shape, dtype=np.uint8)
+            
+        # widen to int16, swapping the channels to BGR on the way
+        noisy = self.__noisy
+        np.copyto(noisy, image_snap[:,:,::-1])
+        
+        if self.__noise_mode == 'BANK':
+            # a random frame of the bank, starting at a random offset
+            flat = noisy.reshape(-1)
+            nvals = flat.size
+            noise = self.__noise_bank[self.__rng.integers(self.__noise_bank.shape[0])]
+            offset = int(self.__rng.integers(nvals))
+            np.add(flat[:nvals-offset], noise[offset:], out=flat[:nvals-offset])
+            np.add(flat[nvals-offset:], noise[:offset], out=flat[nvals-offset:])
+        else:
+            noise = self.__noise_f32
+            self.__rng.standard_normal(dtype=np.float32, out=noise)
+            noise *= self.__noise_std
+            # truncate towards zero, like astype(int)
+            np.trunc(noise, out=noise)
+            np.add(noisy, noise, out=noisy, casting='unsafe')
+        
+        np.clip(noisy, 0, 255, out=noisy)
+        np.copyto(out, noisy, casting='unsafe')
+        return out
             
 
     # take an image of a buoy an add it to the simulated background
     def add_buoy_image_to_image(self, image_snap, R, hdg, elev, color, buoy_length=0.28):
-        if color.lower() == 'red':
-            if self.__buoy_image_red is None:
-                self.__buoy_image_red = np.flip(cv2.imread('data/red_buoy_pool_img.jpg'), axis=2)
-            img = self.__buoy_image_red
-        elif color.lower() == 'green':
-            if self.__buoy_image_green is None:
-                self.__buoy_image_green = np.flip(cv2.imread('data/green_buoy_pool_img.jpg'), axis=2)
-            img = self.__buoy_image_green
-        else:
+        color = color.lower()
+        if color not in ('red', 'green'):
             print(f"Unknown color: {color}")
             sys.exit()
             
         H = R * np.tan(np.radians(elev))
         center_y = np.degrees(np.arctan( H/R ) )        
     
-        center_pix_y = np.where(np.abs(self.__angles_H-center_y) == np.min(np.abs(self.__angles_H-center_y)) )
+        center_pix_y = np.argmin(np.abs(self.__angles_H-center_y))
 
         # image size is 14 cm across
         H = R * np.tan(np.radians(hdg))
         max_x = np.degrees(np.arctan( (H + buoy_length/2)/R ) )
         min_x = np.degrees(np.arctan( (H - buoy_length/2)/R ) )
     
-        # find the pixels that fit here
-        xrng = np.where(np.logical_and(self.__angles_W<=max_x, self.__angles_W>=min_x))
+        # find the pixels that fit here (angles_W is increasing)
+        x0, x1 = self.__pixel_span(self.__angles_W, min_x, max_x)
+        if x1 <= x0:
+            # buoy is out of the frame
+            return image_snap
         
-        pix_y, pix_x, nchan = img.shape
-        pixout_x = xrng[0][-1] - xrng[0][0] + 1
-        mult = pixout_x / pix_x
-        pixout_y = int(mult * pix_y)
-        yoffset = int((pixout_y+1)/2) - 1
-        
-        if pixout_x>0 and pixout_y>0:
-            #print(f"req: {pixout_x}, {pixout_y}")
-            img_scaled = cv2.resize(img, (pixout_x, pixout_y))
-            #print(f"got {img_scaled.shape}")
+        # resized buoy image, reused across frames at similar ranges
+        pixout_x = x1 - x0
+        img_scaled = self.__sprites.get(color, pixout_x)
+        
+        if img_scaled is not None:
+            pixout_y = img_scaled.shape[0]
+            yoffset = int((pixout_y+1)/2) - 1
             
             # should never be > 1, but just in case...    
             frac = np.min((R/self.__MAX_RANGE, 1))
     
-            for ycnt in range(pixout_y):
-                #print(f"cpy = {center_pix_y[0]}")
-                y = ycnt + center_pix_y[0][0] - yoffset
-                if y>=0 and y<self.__Hpix:
-                    for x in xrng[0]:
-                        xcnt = x - xrng[0][0]
-                        #print(f"{ycnt}, {xcnt} -> {y}, {x}")
-                        image_snap[y, x, :] = (frac*image_snap[y,x,:] + (1-frac)*img_scaled[ycnt, xcnt, :]).astype(np.uint8)
+            # rows of the frame covered by the sprite, clipped at the frame edges
+            top = center_pix_y - yoffset
+            y0 = max(top, 0)
+            y1 = min(top + pixout_y, self.__Hpix)
+            if y1 > y0:
+                region = image_snap[y0:y1, x0:x1, :]
+                sprite = img_scaled[(y0-top):(y1-top), :, :]
+                region[...] = (frac*region + (1-frac)*sprite).astype(np.uint8)
                                 
         return image_snap
 
+    # [start, stop) of the pixels whose angles are within [min_angle, max_angle],
+    # for increasing angles
+    def __pixel_span(self, angles, min_angle, max_angle):
+        start = int(np.searchsorted(angles, min_angle, side='left'))
+        stop = int(np.searchsorted(angles, max_angle, side='right'))
+        return start, stop
+
 
     def add_buoy_to_image(self, image_snap, R, hdg, elev, color, buoy_size=0.25):
         if color.lower() == 'red':
@@ -179,28 +317,39 @@ class BWSI_Camera(object):
         max_y = np.degrees(np.arctan( (H + buoy_size/2)/R ) )
         min_y = np.degrees(np.arctan( (H - buoy_size/2)/R ) )
     
-        yrng = np.where(np.logical_and(self.__angles_H<=max_y, self.__angles_H>=min_y))
+        # angles_H is decreasing, so search it reversed
+        y0, y1 = self.__pixel_span(self.__angles_H[::-1], min_y, max_y)
+        y0, y1 = self.__Hpix - y1, self.__Hpix - y0
     
         H = R * np.tan(np.radians(hdg))
         max_x = np.degrees(np.arctan( (H + buoy_size/2)/R ) )
         min_x = np.degrees(np.arctan( (H - buoy_size/2)/R ) )
     
         # find the pixels that fit here
-        xrng = np.where(np.logical_and(self.__angles_W<=max_x, self.__angles_W>=min_x))
+        x0, x1 = self.__pixel_span(self.__angles_W, min_x, max_x)
 
         # should never be > 1, but just in case...    
         frac = np.min((R/vis_rng, 1))
         
         vis_colr = (frac * image_snap[0,0,:] + (1-frac)*buoy_color).astype(np.uint8)
     
-        for y in yrng[0]:
-            for x in xrng[0]:
-                image_snap[y, x, :] = vis_colr
+        image_snap[y0:y1, x0:x1, :] = vis_colr
                 
         return image_snap
     
         
 
+    # (rows, columns, channels) of the frames from get_frame
+    def get_frame_shape(self):
+        return self.FRAME_SHAPE
+    
+    # restart the per-frame random draws (the BANK noise frames are kept).
+    # seed may be anything numpy.random.default_rng accepts
+    def reseed(self, seed):
+        self.__rng = np.random.default_rng(seed)
+        if self.__noise_mode == 'LEGACY':
+            np.random.seed(np.random.SeedSequence(seed).generate_state(1)[0])
+
     def get_visible_buoys_with_range(self, pos, hdg, buoy_field):
         angle_left = np.mod(hdg-self.__MAX_ANGLE+360, 360)
         angle_right = np.mod(hdg+self.__MAX_ANGLE, 360)
@@ -215,6 +364,83 @@ class BWSI_Camera(object):
         
     
     
+## Batch rendering of camera frames, e.g. for offline datasets
+# per-process state of the render_frames workers
+_render_state = dict()
+
+def _render_init(buoy_field, camera_args, seed, filename):
+    _render_state['field'] = buoy_field
+    _render_state['camera'] = BWSI_Camera(seed=seed, **camera_args)
+    _render_state['frames'] = np.load(filename, mmap_mode='r+')
+
+def _render_chunk(positions, headings, start, seed):
+    _render_range(_render_state['camera'],
+                  _render_state['field'],
+                  _render_state['frames'],
+                  positions, headings, start, seed)
+    _render_state['frames'].flush()
+    return len(positions)
+
+# frame start+k is rendered from the k-th pose, with its own random seed so
+# that it comes out the same whichever process renders it
+def _render_range(camera, buoy_field, frames, positions, headings, start, seed):
+    for k in range(len(positions)):
+        camera.reseed((seed, start + k))
+        camera.get_frame(positions[k], headings[k], buoy_field, out=frames[start + k])
+
+# render one camera frame for each (position, heading) pose, spread across
+# workers processes (in this process if workers <= 1). Frames are written
+# into a (N, rows, columns, 3) uint8 .npy file at filename, which is returned
+# as a memmap; with no filename they are returned as an in-memory array.
+# camera_args are passed on to BWSI_Camera, with noise='BANK' unless they say
+# otherwise. The result only depends on seed, not on the number of workers
+def render_frames(positions,
+                  headings,
+                  buoy_field,
+                  filename=None,
+                  workers=None,
+                  seed=0,
+                  camera_args=None):
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    headings = np.broadcast_to(np.asarray(headings, dtype=np.float64), (positions.shape[0],))
+    nFrames = positions.shape[0]
+    if workers is None:
+        workers = os.cpu_count()
+    camera_args = dict() if camera_args is None else dict(camera_args)
+    camera_args.setdefault('noise', 'BANK')
+    
+    tmpdir = None
+    if filename is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmpdir.name, 'frames.npy')
+    frames = np.lib.format.open_memmap(str(filename),
+                                       mode='w+',
+                                       dtype=np.uint8,
+                                       shape=(nFrames,) + BWSI_Camera.FRAME_SHAPE)
+
+    try:
+        if workers <= 1 or nFrames <= 1:
+            camera = BWSI_Camera(seed=seed, **camera_args)
+            _render_range(camera, buoy_field, frames, positions, headings, 0, seed)
+        else:
+            # a few chunks per worker to balance the load
+            bounds = np.linspace(0, nFrames, min(nFrames, 4*workers) + 1).astype(int)
+            tasks = [(positions[a:b], headings[a:b], a, seed) for a, b in zip(bounds[:-1], bounds[1:])]
+            with multiprocessing.Pool(processes=workers,
+                                      initializer=_render_init,
+                                      initargs=(buoy_field, camera_args, seed, str(filename))) as pool:
+                pool.starmap(_render_chunk, tasks)
+        frames.flush()
+        
+        if tmpdir is not None:
+            frames = np.array(frames)
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+            
+    return frames
+    
+    
 class BWSI_Laser(object):
     def __init__(self, visibility):
         self.__MAX_RANGE = visibility # maximum range camera can see
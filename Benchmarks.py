@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing benchmarks for the simulation and processing code.
+
+Run all of them with:
+python Benchmarks.py
+
+or a single one by name, e.g.:
+python Benchmarks.py buoy_index
+
+Add --json <file> to also write the results of the benchmarks that return
+them (e.g. detector) to a JSON file, to compare across commits.
+
+@author: BWSI AUV Challenge Instructional Staff
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import pathlib
+import contextlib
+import tempfile
+import threading
+
+import numpy as np
+import cv2
+
+from BWSI_BuoyField import BuoyField
+from BWSI_Sensor import BWSI_Camera, render_frames
+from Image_Processor import ImageProcessor
+from Logger import FrameRecorder
+from Camera_Capture import ReplayFrameSource
+from BWSI_Sandshark import Sandshark
+from Sandshark_Interface import AsyncSandsharkServer, SandsharkClient, AsyncSandsharkClient
+
+
+# log_dir for an ImageProcessor: the given directory, or with None a temporary
+# one that's removed afterwards
+@contextlib.contextmanager
+def log_directory(log_dir=None):
+    if log_dir is not None:
+        yield log_dir
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield tmpdir
+
+
+# build a linear course of nGates gates heading north-east
+def linear_field(nGates, gate_spacing=5, datum=(42.3, -71.1)):
+    field = BuoyField(datum)
+    config = {'nGates': nGates,
+              'gate_spacing': gate_spacing,
+              'gate_width': 2,
+              'style': 'linear',
+              'max_offset': 5,
+              'heading': 45}
+    field.configure(config)
+    return field
+
+# average seconds per call of func over the list of argument tuples
+def time_calls(func, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    return (time.perf_counter() - start) / len(args_list)
+
+
+# compare grid-indexed and brute force detectable_buoys queries
+def bench_buoy_index(sizes=(100, 1000, 10000, 20000),
+                     n_queries=500,
+                     max_range=50.0,
+                     fov=31.1):
+    print("buoy_index: detectable_buoys, indexed vs. brute force")
+    print(f"{'gates':>8} {'brute (us)':>12} {'index (us)':>12} {'speedup':>8}")
+
+    rs = np.random.RandomState(2021)
+    for nGates in sizes:
+        field = linear_field(nGates)
+        G, R = field.get_buoy_arrays()
+
+        # vehicles scattered along the course, looking in random directions
+        along = rs.randint(0, nGates, n_queries)
+        positions = (G[along] + R[along]) / 2.0 + rs.normal(0, 10, (n_queries, 2))
+        headings = rs.uniform(0, 360, n_queries)
+
+        queries = list()
+        for pos, hdg in zip(positions, headings):
+            queries.append((pos,
+                            max_range,
+                            np.mod(hdg-fov+360, 360),
+                            np.mod(hdg+fov, 360),
+                            'RANGE_ANGLE'))
+
+        brute = time_calls(lambda *q: field.detectable_buoys(*q, use_index=False), queries)
+        index = time_calls(lambda *q: field.detectable_buoys(*q, use_index=True), queries)
+
+        print(f"{nGates:>8d} {brute*1e6:>12.1f} {index*1e6:>12.1f} {brute/index:>8.1f}")
+
+
+# compare one batched fleet query against looping detectable_buoys per vehicle
+def bench_fleet_query(nGates=5000,
+                      fleet_sizes=(1, 10, 50, 200),
+                      n_ticks=20,
+                      max_range=50.0,
+                      fov=31.1):
+    print(f"fleet_query: {nGates} gates, per-vehicle loop vs. detectable_buoys_batch")
+    print(f"{'vehicles':>8} {'loop (ms)':>12} {'batch (ms)':>12} {'speedup':>8}")
+
+    rs = np.random.RandomState(2021)
+    field = linear_field(nGates)
+    G, R = field.get_buoy_arrays()
+
+    for nVehicles in fleet_sizes:
+        along = rs.randint(0, nGates, nVehicles)
+        positions = (G[along] + R[along]) / 2.0 + rs.normal(0, 10, (nVehicles, 2))
+        headings = rs.uniform(0, 360, nVehicles)
+
+        def loop():
+            for pos, hdg in zip(positions, headings):
+                field.detectable_buoys(pos,
+                                       max_range,
+                                       np.mod(hdg-fov+360, 360),
+                                       np.mod(hdg+fov, 360),
+                                       'RANGE_ANGLE')
+
+        def batch():
+            field.detectable_buoys_batch(positions, headings, fov, max_range)
+
+        t_loop = time_calls(loop, [()]*n_ticks)
+        t_batch = time_calls(batch, [()]*n_ticks)
+        print(f"{nVehicles:>8d} {t_loop*1e3:>12.2f} {t_batch*1e3:>12.2f} {t_loop/t_batch:>8.1f}")
+
+
+# the pool course ImageProcessor simulates, and n_frames rendered driving
+# through it; returns the frames and, per frame, the true relative angles
+# (degrees) to the visible green and red buoys
+def pool_frames(n_frames, datum=(42.3, -71.1), max_angle=31.1, visibility=50, seed=0):
+    field = BuoyField(datum)
+    config = {'nGates': 5,
+              'gate_spacing': 5,
+              'gate_width': 2,
+              'style': 'pool_1',
+              'max_offset': 5,
+              'heading': 0}
+    field.configure(config)
+
+    # start short of the first gate and steer through each gate's midpoint
+    G, R = field.get_buoy_arrays()
+    mids = (G+R)/2.0
+    mids = np.vstack((mids[0] - 0.8*(mids[1]-mids[0]), mids))
+    t = np.linspace(0, len(mids)-1, n_frames+1)
+    k = np.minimum(t.astype(int), len(mids)-2)
+    track = mids[k] + (mids[k+1]-mids[k]) * (t-k)[:,np.newaxis]
+    step = np.diff(track, axis=0)
+    positions = track[:-1]
+    headings = np.degrees(np.arctan2(step[:,0], step[:,1]))
+
+    # the camera prints the number of buoys in every frame
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = render_frames(positions, headings, field, workers=1, seed=seed,
+                               camera_args={'max_angle': max_angle,
+                                            'visibility': visibility,
+                                            'noise': 'BANK'})
+
+    truth = list()
+    for pos, hdg in zip(positions, headings):
+        G, R = field.detectable_buoys(pos,
+                                      visibility,
+                                      np.mod(hdg-max_angle+360, 360),
+                                      np.mod(hdg+max_angle, 360),
+                                      'ANGLE')
+        truth.append(tuple(np.mod(np.array(angles) - hdg + 180, 360) - 180 for angles in (G, R)))
+    return frames, truth
+
+# the pool photos in data/, as BGR images
+def pool_images():
+    data_dir = pathlib.Path(__file__).resolve().parent / 'data'
+    return [cv2.imread(str(fn)) for fn in sorted(data_dir.glob('*.jpg'))]
+
+
+# detection latency and angle error for each ImageProcessor detection_scale.
+# Simulated frames are scored against the nearest true buoy angle of the same
+# color, the pool photos against the full resolution detection.
+def bench_detection_scale(scales=(1, 2, 4), n_frames=200, log_dir=None):
+    frames, truth = pool_frames(n_frames)
+    photos = pool_images()
+
+    print("detection_scale: ImageProcessor detection latency vs. angle error (degrees)")
+    print(f"{'images':>12} {'scale':>6} {'ms/frame':>9} {'color':>6} {'found':>6} {'missed':>7} "
+          f"{'mean err':>9} {'p95 err':>8}")
+
+    for name, images in (('simulated', frames), ('pool photos', photos)):
+        reference = None
+        for scale in scales:
+            with log_directory(log_dir) as out_dir:
+                processor = ImageProcessor(camera='SIM',
+                                           log_dir=out_dir,
+                                           log_frames=False,
+                                           fused_detector=True,
+                                           detection_scale=scale)
+                try:
+                    start = time.perf_counter()
+                    # process_image gives (red, green)
+                    angles = [processor.process_image(img)[::-1] for img in images]
+                    latency = (time.perf_counter() - start) / len(images)
+                finally:
+                    processor.close()
+            if reference is None:
+                reference = truth if name == 'simulated' else angles
+
+            for c, color in enumerate(('green', 'red')):
+                found = missed = 0
+                errors = list()
+                for ref, new in zip(reference, angles):
+                    if len(new[c]) > 0 and len(ref[c]) > 0:
+                        found += 1
+                        errors.append(np.min(np.abs(np.asarray(ref[c]) - new[c][0])))
+                    elif len(ref[c]) > 0:
+                        missed += 1
+                errors = np.array(errors) if len(errors) > 0 else np.zeros(1)
+                print(f"{name:>12} {scale:>6d} {latency*1e3:>9.2f} {color:>6} {found:>6d} {missed:>7d} "
+                      f"{errors.mean():>9.3f} {np.percentile(errors, 95):>8.3f}")
+
+
+# detection throughput replaying recorded frames through ImageProcessor as
+# fast as they can be processed. Without a recording (see
+# ImageProcessor(record_file=...)), simulated pool frames are recorded first
+def bench_replay(recording=None, n_frames=200, log_dir=None):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if recording is None:
+            frames, _ = pool_frames(n_frames)
+            recording = pathlib.Path(tmpdir, 'pool')
+            recorder = FrameRecorder(recording, capacity=len(frames))
+            for i, frame in enumerate(frames):
+                recorder.record(frame, timestamp=i/24.0)
+            recorder.close()
+
+        source = ReplayFrameSource(recording, realtime=False)
+        processor = ImageProcessor(camera='REPLAY',
+                                   log_dir=tmpdir if log_dir is None else log_dir,
+                                   log_frames=False,
+                                   frame_source=source)
+        state = {'heading': 0.0}
+        latencies = list()
+        detections = 0
+        try:
+            for _ in range(len(source)):
+                start = time.perf_counter()
+                red, green = processor.run(state)
+                latencies.append(time.perf_counter() - start)
+                detections += len(red) + len(green)
+        finally:
+            processor.close()
+
+    latencies = np.array(latencies)
+    print(f"replay: {len(latencies)} frames through ImageProcessor.run")
+    print(f"{'fps':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'detections':>11}")
+    print(f"{1.0/latencies.mean():>8.1f} {np.percentile(latencies, 50)*1e3:>9.2f} "
+          f"{np.percentile(latencies, 99)*1e3:>9.2f} {detections:>11d}")
+
+
+# end to end latency of the simulated vehicle's BFNVG updates to each client
+# on localhost, with a quiet back seat that sends once a second and collects
+# its mail at mail_rate Hz, as MailLatency measures it (see Sandshark_Interface)
+def bench_nav_latency(clients=('SOCKET', 'ASYNC'), nav_rate=10, mail_rate=10,
+                      duration=5.0, port=29500):
+    print(f"nav_latency: BFNVG at {nav_rate} Hz for {duration} s, mail collected at {mail_rate} Hz")
+    print(f"{'client':>8} {'sent':>5} {'recvd':>6} {'mean (ms)':>9} {'p99 (ms)':>9} "
+          f"{'max (ms)':>9} {'wait (ms)':>10}")
+
+    results = list()
+    for i, transport in enumerate(clients):
+        server = AsyncSandsharkServer(port=port + i)
+        server_thread = threading.Thread(target=server.run, daemon=True)
+        server_thread.start()
+        time.sleep(0.2)
+
+        if transport.upper() == 'ASYNC':
+            client = AsyncSandsharkClient(port=port + i)
+        else:
+            client = SandsharkClient(port=port + i)
+        client_thread = threading.Thread(target=client.run, daemon=True)
+        client_thread.start()
+
+        # the vehicle prints each update
+        with contextlib.redirect_stdout(io.StringIO()):
+            vehicle = Sandshark(latlon=(42.3, -71.1), datum=(42.3, -71.1))
+            sent = 0
+            start = time.monotonic()
+            last = start
+            next_nav = next_mail = next_status = start
+            while time.monotonic() - start < duration:
+                now = time.monotonic()
+                if now >= next_nav:
+                    server.send_command(vehicle.update_state(now - last))
+                    last = now
+                    sent += 1
+                    next_nav += 1.0 / nav_rate
+                if now >= next_status:
+                    client.send_message("$BPSTS,0,1,OK*00\r\n")
+                    next_status += 1.0
+                if now >= next_mail:
+                    client.receive_mail()
+                    next_mail += 1.0 / mail_rate
+                time.sleep(max(0.0, min(next_nav, next_mail, next_status) - time.monotonic()))
+            time.sleep(0.1)
+            client.receive_mail()
+
+        client.cleanup()
+        client_thread.join()
+        server.cleanup()
+        server_thread.join()
+
+        stats = client.get_latency_stats().get('$BFNVG', dict())
+        row = {'client': transport,
+               'sent': sent,
+               'received': stats.get('count', 0),
+               'latency': stats}
+        print(f"{transport:>8} {sent:>5d} {row['received']:>6d} "
+              f"{none_to_nan(stats.get('latency_mean'))*1e3:>9.2f} "
+              f"{none_to_nan(stats.get('latency_p99'))*1e3:>9.2f} "
+              f"{none_to_nan(stats.get('latency_max'))*1e3:>9.2f} "
+              f"{none_to_nan(stats.get('queue_wait_mean'))*1e3:>10.2f}")
+        results.append(row)
+
+    return {'nav_rate': nav_rate,
+            'mail_rate': mail_rate,
+            'duration': duration,
+            'clients': results}
+
+
+# ImageProcessor settings compared by bench_detector
+DETECTORS = {'legacy': {},
+             'fused': {'fused_detector': True, 'multi_blob': True},
+             'fused_scale2': {'fused_detector': True, 'multi_blob': True, 'detection_scale': 2},
+             'fused_scale4': {'fused_detector': True, 'multi_blob': True, 'detection_scale': 4},
+             }
+
+# frames of a single gate, seen from the origin looking north, over a sweep of
+# ranges and bearings to the gate's center; returns the frames, the true
+# relative angles (degrees) to the green and red buoy in each, if in view, and
+# the (range, bearing) of each frame
+def gate_sweep_frames(ranges, bearings, repeats=1, gate_width=2.0,
+                      max_angle=31.1, visibility=50, datum=(42.3, -71.1), seed=0):
+    camera = BWSI_Camera(max_angle=max_angle, visibility=visibility, noise='BANK', seed=seed)
+    frames = list()
+    truth = list()
+    labels = list()
+    for rng in ranges:
+        for brg in bearings:
+            center = rng * np.array([np.sin(np.radians(brg)), np.cos(np.radians(brg))])
+            # green on the left of the gate, red on the right
+            left = (gate_width/2.0) * np.array([-np.cos(np.radians(brg)), np.sin(np.radians(brg))])
+            green = center + left
+            red = center - left
+            field = BuoyField(datum, [tuple(green)], [tuple(red)], position_style='P')
+            angles = list()
+            for b in (green, red):
+                angle = np.degrees(np.arctan2(b[0], b[1]))
+                in_view = abs(angle) <= max_angle and np.hypot(b[0], b[1]) <= visibility
+                angles.append([angle] if in_view else [])
+            for _ in range(repeats):
+                # the camera prints the number of buoys in every frame
+                with contextlib.redirect_stdout(io.StringIO()):
+                    frames.append(camera.get_frame((0.0, 0.0), 0.0, field))
+                truth.append(angles)
+                labels.append((rng, brg))
+    return frames, truth, labels
+
+def none_to_nan(value):
+    return np.nan if value is None else value
+
+# angle error (degrees) against the nearest true buoy of the same color
+def angle_error_stats(truth, angles, color):
+    errors = list()
+    missed = 0
+    for ref, new in zip(truth, angles):
+        if len(ref[color]) == 0:
+            continue
+        if len(new[color]) == 0:
+            missed += 1
+            continue
+        errors.append(np.min(np.abs(np.asarray(ref[color]) - new[color][0])))
+    if len(errors) == 0:
+        # None rather than NaN, which isn't valid JSON
+        return {'found': 0, 'missed': missed,
+                'mean_error': None, 'p95_error': None, 'max_error': None}
+    return {'found': len(errors),
+            'missed': missed,
+            'mean_error': float(np.mean(errors)),
+            'p95_error': float(np.percentile(errors, 95)),
+            'max_error': float(np.max(errors))}
+
+
+# throughput, latency, peak memory and angle error of each detector on
+# labelled frames of a gate over a sweep of ranges and bearings. Peak memory is
+# what tracemalloc sees: numpy arrays, including OpenCV's outputs
+def bench_detector(detectors=DETECTORS,
+                   ranges=(3, 5, 10, 20, 30, 45),
+                   bearings=np.arange(-25, 26, 5),
+                   repeats=3,
+                   n_memory=20,
+                   log_dir=None):
+    frames, truth, labels = gate_sweep_frames(ranges, bearings, repeats)
+    frame_ranges = np.array([rng for rng, _ in labels])
+
+    print(f"detector: {len(frames)} frames, {len(ranges)} ranges x {len(bearings)} bearings x {repeats}")
+    print(f"{'detector':>13} {'fps':>7} {'p50 (ms)':>9} {'p99 (ms)':>9} {'peak (MB)':>10} "
+          f"{'color':>6} {'found':>6} {'missed':>7} {'mean err':>9} {'p95 err':>8}")
+
+    results = list()
+    for name, settings in detectors.items():
+        with log_directory(log_dir) as out_dir:
+            processor = ImageProcessor(camera='SIM', log_dir=out_dir, log_frames=False, **settings)
+            try:
+                # the original detectors print every contour when they find several
+                with contextlib.redirect_stdout(io.StringIO()), np.errstate(all='ignore'):
+                    for frame in frames[:3]:
+                        processor.process_image(frame)
+
+                    latencies = np.empty(len(frames))
+                    angles = list()
+                    for i, frame in enumerate(frames):
+                        start = time.perf_counter()
+                        red, green = processor.process_image(frame)
+                        latencies[i] = time.perf_counter() - start
+                        angles.append((green, red))
+
+                    tracemalloc.start()
+                    for frame in frames[:n_memory]:
+                        processor.process_image(frame)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+            finally:
+                processor.close()
+
+        row = {'detector': name,
+               'settings': settings,
+               'frames': len(frames),
+               'fps': float(1.0 / latencies.mean()),
+               'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+               'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+               'peak_mb': peak / 2**20}
+        for c, color in enumerate(('green', 'red')):
+            row[color] = angle_error_stats(truth, angles, c)
+            row[color]['by_range'] = dict()
+            for rng in ranges:
+                subset = np.flatnonzero(frame_ranges == rng)
+                row[color]['by_range'][str(rng)] = angle_error_stats([truth[i] for i in subset],
+                                                                      [angles[i] for i in subset],
+                                                                      c)
+            print(f"{name:>13} {row['fps']:>7.1f} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+                  f"{row['peak_mb']:>10.2f} {color:>6} {row[color]['found']:>6d} "
+                  f"{row[color]['missed']:>7d} {none_to_nan(row[color]['mean_error']):>9.3f} "
+                  f"{none_to_nan(row[color]['p95_error']):>8.3f}")
+        results.append(row)
+
+    return {'ranges': [float(r) for r in ranges],
+            'bearings': [float(b) for b in bearings],
+            'repeats': repeats,
+            'detectors': results}
+
+
+BENCHMARKS = {'buoy_index': bench_buoy_index,
+              'fleet_query': bench_fleet_query,
+              'detection_scale': bench_detection_scale,
+              'replay': bench_replay,
+              'detector': bench_detector,
+              'nav_latency': bench_nav_latency,
+              }
+
+# commit and versions the results were measured with
+def run_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=pathlib.Path(__file__).resolve().parent,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run timing benchmarks")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default all)")
+    parser.add_argument('--json', help="write the benchmark results to this JSON file")
+    args = parser.parse_args()
+
+    names = args.names if len(args.names) > 0 else list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}")
+            sys.exit(-1)
+
+    results = dict()
+    for name in names:
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+        print()
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'run': run_info(), 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
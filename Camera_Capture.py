@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame sources for ImageProcessor, and continuous camera capture on a
+background thread.
+
+A frame source has a get_frame(auv_state) method returning the next BGR frame
+and its capture time (time.monotonic()), or (None, None) if there isn't one,
+and a close() method. make_frame_source builds the SIM (simulated camera),
+PICAM (Raspberry Pi camera) and REPLAY (frames logged to disk) sources.
+
+ContinuousCapture keeps a stream capturing into a ring of frame buffers
+(triple buffered by default), so the latest complete frame can be picked up
+at any time without waiting on the camera. A stream is any object with a
+stream(outputs) method that fills each numpy buffer drawn from the outputs
+iterator with a frame, in turn, until the iterator runs out, and a reset()
+method to recover after an error.
+
+PiCameraStream streams from a PiCamera's video port. SyntheticStream is a
+stand-in that draws frames in software at a fixed rate, for testing without
+the camera hardware.
+
+@author: BWSI AUV Challenge Instructional Staff
+"""
+import time
+import pathlib
+import threading
+import traceback
+
+import numpy as np
+import cv2
+
+# only needed on the vehicle
+try:
+    import picamera
+except ImportError:
+    picamera = None
+
+from BWSI_BuoyField import BuoyField
+from BWSI_Sensor import BWSI_Camera
+from Logger import FrameRecording
+
+
+# camera is 'SIM', 'PICAM' or 'REPLAY'; kwargs go to that source's constructor
+def make_frame_source(camera='SIM', **kwargs):
+    if camera.upper() == 'SIM':
+        return SimFrameSource(**kwargs)
+    elif camera.upper() == 'PICAM':
+        return PiCameraFrameSource(**kwargs)
+    elif camera.upper() == 'REPLAY':
+        return ReplayFrameSource(**kwargs)
+    else:
+        raise ValueError(f"Unknown camera type: {camera}")
+
+
+# frames rendered by the simulated camera, looking at the pool course from the
+# vehicle's position and heading
+class SimFrameSource():
+    def __init__(self, max_angle=31.1, visibility=50):
+        self.__camera = BWSI_Camera(max_angle=max_angle, visibility=visibility)
+        self.__simField = None
+
+    def get_frame(self, auv_state):
+        # if it's the first time through, configure the buoy field
+        if self.__simField is None:
+            self.__simField = BuoyField(auv_state['datum'])
+            config = {'nGates': 5,
+                      'gate_spacing': 5,
+                      'gate_width': 2,
+                      'style': 'pool_1',
+                      'max_offset': 5,
+                      'heading': 0}
+
+            self.__simField.configure(config)
+
+        # synthesize an image
+        image = self.__camera.get_frame(auv_state['position'], auv_state['heading'], self.__simField)
+        return image, time.monotonic()
+
+    def close(self):
+        pass
+
+
+# frames from the Raspberry Pi camera, captured on demand from the still port,
+# or with continuous=True streamed from the video port on a background thread
+class PiCameraFrameSource():
+    def __init__(self, continuous=False, buffers=3):
+        if picamera is None:
+            raise ImportError("The PICAM camera needs the picamera package")
+
+        self.__continuous = continuous
+        if continuous:
+            self.__capture = ContinuousCapture(PiCameraStream(self.__make_camera),
+                                               frame_shape=(480, 640, 3),
+                                               n_buffers=buffers)
+            self.__capture.start()
+        else:
+            self.__camera = self.__make_camera()
+            self.__image = np.empty((480*640*3,), dtype=np.uint8)
+
+    def get_frame(self, auv_state):
+        if self.__continuous:
+            return self.__capture.get_frame()
+
+        try:
+            self.__camera.capture(self.__image, 'bgr')
+        except:
+            # restart the camera
+            self.__camera = picamera.PiCamera()
+            self.__camera.resolution = (640, 480)
+            self.__camera.rotation = 180
+            self.__camera.framerate = 24
+            time.sleep(0.5) # camera warmup time
+
+        return self.__image.reshape((480, 640, 3)), time.monotonic()
+
+    def close(self):
+        if self.__continuous:
+            self.__capture.stop()
+
+    def __make_camera(self):
+        camera = picamera.PiCamera()
+        camera.resolution = (640, 480)
+        camera.framerate = 24
+        time.sleep(2) # camera warmup time
+        return camera
+
+
+# capture time in seconds from a FrameLogger file name, frame_<n>_<ms>.jpg, or
+# the older frame_<s>.jpg; None for other names
+def _logged_frame_time(fn):
+    parts = fn.stem.split('_')
+    try:
+        if len(parts) == 3:
+            return int(parts[2]) / 1000.0
+        elif len(parts) == 2:
+            return float(parts[1])
+    except ValueError:
+        pass
+    return None
+
+# frames logged on an earlier run: path is either a directory of JPEG frames
+# from FrameLogger, or the base name of a FrameRecorder recording. With
+# realtime=True frames are played back at the pace they were captured, and
+# get_frame returns the latest frame due; otherwise every frame is returned in
+# turn, as fast as they are asked for. Past the last frame get_frame returns
+# (None, None), or with loop=True starts over.
+class ReplayFrameSource():
+    def __init__(self, path, realtime=True, loop=False, rate=24):
+        path = pathlib.Path(path)
+        self.__realtime = realtime
+        self.__loop = loop
+
+        if path.is_dir():
+            files = sorted(path.glob('*.jpg'))
+            times = [_logged_frame_time(fn) for fn in files]
+            if len(files) > 0 and all(t is not None for t in times):
+                # in capture order; the frame number breaks ties
+                order = sorted(range(len(files)), key=lambda i: (times[i], files[i].name))
+                self.__files = [files[i] for i in order]
+                self.__times = np.array([times[i] for i in order])
+            else:
+                # no times in the names, assume a steady frame rate
+                self.__files = files
+                self.__times = np.arange(len(files)) / rate
+            self.__recording = None
+        else:
+            self.__recording = FrameRecording(path)
+            self.__files = None
+            self.__times = np.asarray(self.__recording.get_times())
+
+        self.__count = len(self.__times)
+        self.__next = 0
+        self.__start = None
+        self.__last = (None, None)
+
+    def __len__(self):
+        return self.__count
+
+    # position in the replay of the last frame returned
+    def get_index(self):
+        return self.__next - 1
+
+    def get_frame(self, auv_state=None):
+        now = time.monotonic()
+        if self.__start is None:
+            self.__start = now
+
+        if self.__next >= self.__count:
+            # played the last frame
+            if not self.__loop or self.__count == 0:
+                return None, None
+            self.__start = now
+            self.__next = 0
+
+        if self.__realtime:
+            # latest frame due, repeating the last one if the next isn't due yet
+            elapsed = now - self.__start
+            due = np.searchsorted(self.__times, self.__times[0] + elapsed, side='right') - 1
+            i = int(max(due, self.__next - 1, 0))
+            capture_time = self.__start + (self.__times[i] - self.__times[0])
+        else:
+            i = self.__next
+            capture_time = now
+        self.__next = max(self.__next, i + 1)
+
+        if self.__last[0] != i:
+            if self.__recording is not None:
+                self.__last = (i, self.__recording.get_frame(i))
+            else:
+                self.__last = (i, cv2.imread(str(self.__files[i])))
+        return self.__last[1], capture_time
+
+    def close(self):
+        pass
+
+
+class ContinuousCapture():
+    def __init__(self, stream, frame_shape=(480, 640, 3), n_buffers=3):
+        if n_buffers < 2:
+            raise ValueError("ContinuousCapture needs at least 2 buffers")
+
+        self.__stream = stream
+        self.__frame_shape = tuple(frame_shape)
+        self.__buffers = [np.zeros(self.__frame_shape, dtype=np.uint8) for _ in range(n_buffers)]
+        self.__times = [None] * n_buffers
+
+        # latest complete frame, the one handed out by get_frame, and the
+        # one being captured into
+        self.__latest = None
+        self.__reading = None
+        self.__writing = None
+        self.__cond = threading.Condition()
+
+        self.__captured = 0
+        self.__skipped = 0
+        self.__fresh = False
+
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def is_running(self):
+        return self.__running
+
+    # the latest complete frame and its capture time (time.monotonic()), or
+    # (None, None) before the first frame. The frame is not written to until
+    # the next call to get_frame or release; with only 2 buffers, capture
+    # pauses while it's held
+    def get_frame(self):
+        with self.__cond:
+            if self.__latest is None:
+                return None, None
+            self.__reading = self.__latest
+            self.__fresh = False
+            self.__cond.notify_all()
+            return self.__buffers[self.__reading], self.__times[self.__reading]
+
+    # hand back the frame from get_frame
+    def release(self):
+        with self.__cond:
+            self.__reading = None
+            self.__cond.notify_all()
+
+    # seconds since the latest complete frame was captured, None before the
+    # first frame
+    def get_frame_age(self):
+        with self.__cond:
+            if self.__latest is None:
+                return None
+            return time.monotonic() - self.__times[self.__latest]
+
+    # frames captured, and frames replaced before get_frame picked them up
+    def get_stats(self):
+        with self.__cond:
+            return {'captured': self.__captured,
+                    'skipped': self.__skipped}
+
+    def __run(self):
+        while self.__running:
+            try:
+                self.__stream.stream(self.__outputs())
+            except:
+                traceback.print_exc()
+                if self.__running:
+                    time.sleep(0.5)
+                    self.__stream.reset()
+
+    # hand the stream a free buffer for each frame, publishing the previous
+    # buffer when the next one is asked for, i.e. once it's complete
+    def __outputs(self):
+        try:
+            while True:
+                with self.__cond:
+                    while self.__running:
+                        free = [i for i in range(len(self.__buffers))
+                                if i != self.__latest and i != self.__reading]
+                        if len(free) > 0:
+                            break
+                        # double buffered and the reader holds the other buffer
+                        self.__cond.wait()
+                    if not self.__running:
+                        return
+                    self.__writing = free[0]
+
+                yield self.__buffers[self.__writing]
+
+                with self.__cond:
+                    if self.__fresh:
+                        self.__skipped += 1
+                    self.__times[self.__writing] = time.monotonic()
+                    self.__latest = self.__writing
+                    self.__writing = None
+                    self.__captured += 1
+                    self.__fresh = True
+        finally:
+            # a frame cut short by an error or stop is never published
+            with self.__cond:
+                self.__writing = None
+
+
+# BGR frames from a PiCamera's video port, which keeps the capture pipeline
+# running between frames instead of re-arming the still port every time
+class PiCameraStream():
+    def __init__(self, make_camera):
+        # make_camera returns a configured PiCamera, and is called again to
+        # restart the camera after an error
+        self.__make_camera = make_camera
+        self.__camera = make_camera()
+
+    def get_camera(self):
+        return self.__camera
+
+    def stream(self, outputs):
+        self.__camera.capture_sequence(outputs, format='bgr', use_video_port=True)
+
+    def reset(self):
+        try:
+            self.__camera.close()
+        except:
+            pass
+        self.__camera = self.__make_camera()
+
+
+# software stand-in for a camera: render(out, i) draws frame i into out, and
+# frames are produced at rate frames/second (as fast as possible if None).
+# The default render fills a plain frame with a gray level that counts frames
+class SyntheticStream():
+    def __init__(self, render=None, rate=24):
+        self.__render = render if render is not None else self.__count_frames
+        self.__rate = rate
+        self.__count = 0
+
+    def stream(self, outputs):
+        next_time = time.monotonic()
+        for out in outputs:
+            # wait for the frame's time, then draw it
+            if self.__rate is not None:
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += 1.0 / self.__rate
+            self.__render(out, self.__count)
+            self.__count += 1
+
+    def reset(self):
+        pass
+
+    def __count_frames(self, out, i):
+        out[...] = i % 256
@@ -8,43 +8,120 @@ Created on Thu Jul 22 11:30:37 2021
 ### JRE: for simulation only!
 ### MDM: added Rasperry Pi V2 camera 
 
-import sys
 import pathlib
-import datetime
 
 import time 
+import threading
+import traceback
 import numpy as np
 import getpass
 
-if True:
-    import picamera 
-    import picamera.array
-
 import cv2
 
-# For simulations
-from BWSI_BuoyField import BuoyField
-from BWSI_Sensor import BWSI_Camera
+from Logger import FrameLogger, FrameRecorder
+from Camera_Capture import make_frame_source
 
 
 class ImageProcessor():
-    def __init__(self, camera='SIM', log_dir='./'):
+    # inclusive (B, G, R) bounds of the smoothed pixel colors for each buoy,
+    # the same as the exclusive thresholds of __detect_red_buoy/__detect_green_buoy
+    RED_BOUNDS = ((151, 1, 51), (254, 99, 254))
+    GREEN_BOUNDS = ((221, 81, 1), (234, 239, 19))
+    # columns of the (N, 7) blob arrays: centroid, area and bounding box, in
+    # pixels. Blobs are sorted largest first
+    BLOB_COLUMNS = ('x', 'y', 'area', 'left', 'top', 'width', 'height')
+    
+    def __init__(self,
+                 camera='SIM',
+                 log_dir='./',
+                 fused_detector=False,
+                 multi_blob=False,
+                 track_roi=False,
+                 roi_margin=80,
+                 full_frame_interval=24,
+                 detection_scale=1,
+                 log_frames=True,
+                 frame_quality=95,
+                 frame_every=1,
+                 frame_queue_size=8,
+                 record_file=None,
+                 record_capacity=1000,
+                 continuous_capture=False,
+                 capture_buffers=3,
+                 replay_path=None,
+                 replay_realtime=True,
+                 frame_source=None):
         self.__camera_type = camera.upper()
-
-        if self.__camera_type == 'SIM':
-            self.__camera = BWSI_Camera(max_angle=31.1, visibility=50)
-            self.__simField = None
-            
+        # detect both colors in one pass, rather than one detector per color.
+        # Off by default: its first angle is the largest blob's centroid, not
+        # the original detector's first outline, and AUVController hasn't been
+        # checked against it on frames with several buoys of a color
+        self.__fused_detector = fused_detector
+        # report every blob of each color rather than just the largest
+        self.__multi_blob = multi_blob
+        
+        # run the detector on an image downsampled by 2 or 4, with its kernels
+        # scaled to match; centers are mapped back to full resolution pixels
+        if detection_scale not in (1, 2, 4):
+            raise ValueError(f"Unsupported detection scale {detection_scale}")
+        if detection_scale != 1 and not fused_detector:
+            raise ValueError("detection_scale requires the fused detector")
+        self.__detection_scale = detection_scale
+        
+        # tracking mode: once a buoy is found, only search a region of interest
+        # within roi_margin pixels of the last centers, widening it when a buoy
+        # is lost and searching the full frame every full_frame_interval frames
+        self.__track_roi = track_roi
+        self.__roi_base_margin = roi_margin
+        self.__roi_margin = roi_margin
+        self.__full_frame_interval = full_frame_interval
+        self.__frames_since_full = 0
+        self.__last_blobs = [self.__no_blobs(), self.__no_blobs()]
+        
+        # blobs found in the last image
+        self.__blobs = (self.__no_blobs(), self.__no_blobs())
+
+        # where frames come from: SIM renders them, PICAM captures them (with
+        # continuous_capture, on a background thread) and REPLAY plays back the
+        # frames logged at replay_path. Any other object with the frame source
+        # get_frame/close methods can be passed in as frame_source
+        if frame_source is not None:
+            self.__source = frame_source
+        elif self.__camera_type == 'SIM':
+            self.__source = make_frame_source('SIM', max_angle=31.1, visibility=50)
+        elif self.__camera_type == 'PICAM':
+            self.__source = make_frame_source('PICAM',
+                                              continuous=continuous_capture,
+                                              buffers=capture_buffers)
+        elif self.__camera_type == 'REPLAY':
+            self.__source = make_frame_source('REPLAY',
+                                              path=replay_path,
+                                              realtime=replay_realtime)
         else:
-            self.__camera = picamera.PiCamera()
-            self.__camera.resolution = (640, 480)
-            self.__camera.framerate = 24
-            time.sleep(2) # camera warmup time
-            self.__image = np.empty((480*640*3,), dtype=np.uint8)
-
-        # create my save directory
+            raise ValueError(f"Unknown camera type: {camera}")
+        
+        # seconds between capturing and processing the last frame, its capture
+        # time, and the angles found in it, for when a source hands the same
+        # frame back again
+        self.__frame_age = None
+        self.__frame_time = None
+        self.__angles = (list(), list())
+
+        # frames are written to my save directory on a background thread, keeping
+        # every frame_every'th frame and dropping the oldest when it falls behind
         self.__image_dir = pathlib.Path(log_dir, 'frames')
-        self.__image_dir.mkdir(parents=True, exist_ok=True)
+        self.__frame_logger = None
+        if log_frames:
+            self.__frame_logger = FrameLogger(self.__image_dir,
+                                              queue_size=frame_queue_size,
+                                              quality=frame_quality,
+                                              every=frame_every)
+        
+        # raw frames for post-dive analysis, in a ring buffer of the latest
+        # record_capacity frames (see Logger.FrameRecording to read it back)
+        self.__recorder = None
+        if record_file is not None:
+            self.__recorder = FrameRecorder(record_file, capacity=record_capacity)
 
     def __detect_red_buoy(self, small_img):
     
@@ -136,6 +213,76 @@ class ImageProcessor():
         else:
             return np.array([])
 
+    # find the red and the green buoy in one pass over the image, smoothing
+    # it once and working on uint8/uint16 masks; scale shrinks the kernels for
+    # an image that has been downsampled by that factor
+    def __detect_buoys(self, img, scale=1):
+        if img.dtype != np.uint8:
+            img = img.astype(np.uint8)
+        
+        smooth = max(10 // scale, 1)
+        window = 50 // scale
+        small_img = cv2.boxFilter(img, -1, (smooth,smooth)) #reduce noise with smoothing
+        
+        blobs = list()
+        for lower, upper in (self.GREEN_BOUNDS, self.RED_BOUNDS):
+            mask = cv2.inRange(small_img, lower, upper)
+            # 0/1 so the window counts fit in uint16
+            np.bitwise_and(mask, 1, out=mask)
+            counts = cv2.boxFilter(mask, cv2.CV_16U, (window,window), normalize=False)
+            
+            max_count = int(counts.max())
+            if max_count == 0:
+                blobs.append(self.__no_blobs())
+                continue
+            
+            # same as scaling the counts to 0-255 and thresholding above 217
+            min_count = int(np.ceil(218 * max_count / 255))
+            img_out = cv2.compare(counts, min_count, cv2.CMP_GE)
+            blobs.append(self.__blob_stats(img_out))
+        
+        return blobs[0], blobs[1]
+    
+    def __no_blobs(self):
+        return np.empty((0, len(self.BLOB_COLUMNS)))
+    
+    # centroid, area and bounding box of each blob in the binary image, largest
+    # first, from the moments of its outline. CHAIN_APPROX_SIMPLE keeps only the
+    # outline's corners, and is much faster here than connectedComponentsWithStats
+    def __blob_stats(self, img_out):
+        if cv2.__version__ == '3.2.0':
+            _, contours, hierarchy = cv2.findContours(img_out, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        else:
+            contours, hierarchy = cv2.findContours(img_out, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        
+        blobs = np.empty((len(contours), len(self.BLOB_COLUMNS)))
+        for i, contour in enumerate(contours):
+            m = cv2.moments(contour)
+            if m['m00'] > 0:
+                blobs[i,0:3] = (m['m10']/m['m00'], m['m01']/m['m00'], m['m00'])
+            else:
+                # a line or a point has no area inside its outline
+                blobs[i,0:2] = contour.reshape(-1, 2).mean(axis=0)
+                blobs[i,2] = 0.0
+            blobs[i,3:7] = cv2.boundingRect(contour)
+        return blobs[np.argsort(-blobs[:,2], kind='stable')]
+    
+    # a blob array for a center from the original detectors, which don't
+    # measure the area or bounding box
+    def __center_blob(self, center):
+        if center.size == 0:
+            return self.__no_blobs()
+        blob = np.full((1, len(self.BLOB_COLUMNS)), np.nan)
+        blob[0,0:2] = center
+        return blob
+    
+    # move blobs found in a region of interest into full image coordinates
+    def __shift_blobs(self, blobs, x0, y0):
+        blobs = blobs.copy()
+        blobs[:,[0,3]] += x0
+        blobs[:,[1,4]] += y0
+        return blobs
+
     def __sensor_position(self, pix_x, res_x): 
         sensor_pos_x = (pix_x - (res_x / 2.0)) / res_x * 3.68
 
@@ -149,66 +296,270 @@ class ImageProcessor():
         
         return horizontal_angle
 
+    def __detect(self, img):
+        if self.__detection_scale > 1:
+            return self.__detect_scaled(img)
+        elif self.__fused_detector:
+            return self.__detect_buoys(img)
+        else:
+            return (self.__center_blob(self.__detect_green_buoy(img)),
+                    self.__center_blob(self.__detect_red_buoy(img)))
+    
+    # detect on an area-averaged downsampled copy, then map the blobs back
+    # to pixel coordinates in img
+    def __detect_scaled(self, img):
+        scale = self.__detection_scale
+        rows, cols = img.shape[:2]
+        if rows // scale == 0 or cols // scale == 0:
+            return self.__no_blobs(), self.__no_blobs()
+        
+        if img.dtype != np.uint8:
+            img = img.astype(np.uint8)
+        # halve repeatedly: OpenCV's 2x area resize is much faster than its 4x
+        small = img
+        for _ in range(scale.bit_length() - 1):
+            small = cv2.resize(small,
+                               (small.shape[1] // 2, small.shape[0] // 2),
+                               interpolation=cv2.INTER_AREA)
+        small_rows, small_cols = small.shape[:2]
+        
+        sx = cols / small_cols
+        sy = rows / small_rows
+        blobs = list()
+        for small_blobs in self.__detect_buoys(small, scale):
+            b = small_blobs.copy()
+            # small pixel i covers full pixels [i*scale, (i+1)*scale)
+            b[:,0] = (b[:,0] + 0.5) * sx - 0.5
+            b[:,1] = (b[:,1] + 0.5) * sy - 0.5
+            b[:,2] *= sx * sy
+            b[:,[3,5]] *= sx
+            b[:,[4,6]] *= sy
+            blobs.append(b)
+        return blobs[0], blobs[1]
+    
+    # region of interest (x0, y0, x1, y1) around the last blob centers, None
+    # to search the full frame
+    def __roi(self, img):
+        rows, cols = img.shape[:2]
+        tracked = [b for b in self.__last_blobs if len(b) > 0]
+        if len(tracked) == 0 or self.__frames_since_full >= self.__full_frame_interval:
+            return None
+        
+        xs = np.concatenate([b[:,0] for b in tracked])
+        ys = np.concatenate([b[:,1] for b in tracked])
+        margin = self.__roi_margin
+        x0 = max(int(min(xs)) - margin, 0)
+        y0 = max(int(min(ys)) - margin, 0)
+        x1 = min(int(max(xs)) + margin + 1, cols)
+        y1 = min(int(max(ys)) + margin + 1, rows)
+        if x0 == 0 and y0 == 0 and x1 == cols and y1 == rows:
+            return None
+        return (x0, y0, x1, y1)
+    
+    def __detect_tracked(self, img):
+        roi = self.__roi(img)
+        if roi is None:
+            blobs = list(self.__detect(img))
+            self.__frames_since_full = 0
+            self.__roi_margin = self.__roi_base_margin
+            self.__last_blobs = list(blobs)
+            return blobs
+        
+        x0, y0, x1, y1 = roi
+        blobs = list(self.__detect(img[y0:y1, x0:x1]))
+        self.__frames_since_full += 1
+        
+        lost = False
+        for i in range(len(blobs)):
+            if len(blobs[i]) > 0:
+                blobs[i] = self.__shift_blobs(blobs[i], x0, y0)
+                self.__last_blobs[i] = blobs[i]
+            elif len(self.__last_blobs[i]) > 0:
+                # keep looking where it was, over a wider region
+                lost = True
+        
+        if lost:
+            self.__roi_margin = 2*self.__roi_margin
+        else:
+            self.__roi_margin = self.__roi_base_margin
+        
+        return blobs
+    
     def __buoy_angles(self, img):
-        green_center = self.__detect_green_buoy(img)
-        red_center = self.__detect_red_buoy(img)
+        if self.__track_roi:
+            green_blobs, red_blobs = self.__detect_tracked(img)
+        else:
+            green_blobs, red_blobs = self.__detect(img)
+        if not self.__multi_blob:
+            green_blobs = green_blobs[:1]
+            red_blobs = red_blobs[:1]
+        self.__blobs = (red_blobs, green_blobs)
+        
+        # one angle per blob, largest blob first
         img_x = img.shape[1]
-        green_horiz = list()
-        red_horiz = list()
-        if green_center.any():
-            green_x = green_center[0]
-            green_pos_x = self.__sensor_position(green_x, img_x)
-            #green_horiz = list(__sensor_angles(green_pos_x))
-            g_sa = self.__sensor_angles(green_pos_x)
-            green_horiz.append(g_sa)
-        if red_center.any():
-            red_x = red_center[0]
-            red_pos_x = self.__sensor_position(red_x, img_x)
-            r_sa = self.__sensor_angles(red_pos_x)
-            red_horiz.append(r_sa)
+        green_horiz = list(self.__sensor_angles(self.__sensor_position(green_blobs[:,0], img_x)))
+        red_horiz = list(self.__sensor_angles(self.__sensor_position(red_blobs[:,0], img_x)))
         return (green_horiz, red_horiz)
     
+    # horizontal angles (degrees) to the red and green buoys in a BGR image,
+    # one per blob with the largest first
+    def process_image(self, image):
+        green, red = self.__buoy_angles(image)
+        return red, green
+    
+    # the red and green blob arrays (see BLOB_COLUMNS) behind the angles from
+    # the last image processed
+    def get_blobs(self):
+        return self.__blobs
+    
+    # frames, written, dropped and queued counts of the frame logger
+    def get_frame_log_stats(self):
+        if self.__frame_logger is None:
+            return None
+        return self.__frame_logger.get_stats()
+    
+    # seconds from capture to processing of the frame used by the last run,
+    # None if it had no frame
+    def get_frame_age(self):
+        return self.__frame_age
+    
+    # capture time (time.monotonic()) of the last frame processed, None before
+    # the first
+    def get_frame_time(self):
+        return self.__frame_time
+    
+    # stop capturing, and finish writing any queued and recorded frames
+    def close(self):
+        self.__source.close()
+        if self.__frame_logger is not None:
+            self.__frame_logger.close()
+        if self.__recorder is not None:
+            self.__recorder.close()
+            self.__recorder = None
+    
     def run(self, auv_state=None):
         red = list()
         green = list()
         if auv_state['heading'] is not None:
-            if (self.__camera_type == 'SIM'):
-                # if it's the first time through, configure the buoy field
-                if self.__simField is None:
-                    self.__simField = BuoyField(auv_state['datum'])
-                    config = {'nGates': 5,
-                              'gate_spacing': 5,
-                              'gate_width': 2,
-                              'style': 'pool_1',
-                              'max_offset': 5,
-                              'heading': 0}
-                    
-                    self.__simField.configure(config)
-                 
-                # synthesize an image
-                image = self.__camera.get_frame(auv_state['position'], auv_state['heading'], self.__simField)
-
-            elif self.__camera_type == 'PICAM':
-                try:
-                    self.__camera.capture(self.__image, 'bgr')
-                except:
-                    # restart the camera
-                    self.__camera = picamera.PiCamera()
-                    self.__camera.resolution = (640, 480)
-                    self.__camera.rotation = 180
-                    self.__camera.framerate = 24
-                    time.sleep(0.5) # camera warmup time
-                    
-                image = self.__image.reshape((480, 640, 3))
-        
-            else:
-                print(f"Unknown camera type: {self.__camera_type}")
-                sys.exit(-10)
+            image, capture_time = self.__source.get_frame(auv_state)
+            if image is None:
+                # no frame yet, or the replay is over
+                self.__frame_age = None
+                return red, green
+            self.__frame_age = time.monotonic() - capture_time
+            if capture_time == self.__frame_time:
+                # the same frame again (a continuous capture or realtime replay
+                # that hasn't moved on): it's already been logged and processed
+                return list(self.__angles[0]), list(self.__angles[1])
+            self.__frame_time = capture_time
         
             # log the image
-            fn = self.__image_dir / f"frame_{int(datetime.datetime.utcnow().timestamp())}.jpg"
-            cv2.imwrite(str(fn), image)
+            if self.__frame_logger is not None:
+                self.__frame_logger.log_frame(image)
+            if self.__recorder is not None:
+                self.__recorder.record(image,
+                                       position=auv_state['position'],
+                                       heading=auv_state['heading'])
         
-            green,red = self.__buoy_angles(image)
+            red, green = self.process_image(image)
+            self.__angles = (red, green)
         
         return red, green
+
+
+# holds the most recent value put into it, with its time (time.monotonic())
+# and a sequence number that counts the puts, for one thread to hand results
+# to another without queueing them up
+class LatestValue():
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = None
+        self.__time = None
+        self.__seq = 0
+    
+    def put(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.__lock:
+            self.__value = value
+            self.__time = timestamp
+            self.__seq += 1
+    
+    # (value, time, seq), with seq 0 and value None before the first put
+    def get(self):
+        with self.__lock:
+            return self.__value, self.__time, self.__seq
+
+
+# runs an ImageProcessor on its own thread, so capture and detection don't hold
+# up the control loop. The latest vehicle state is handed in with
+# update_state, and each result is published as (red, green) to a LatestValue
+# slot, timestamped with when its frame was captured. The processor runs at
+# most rate times a second, by default the camera's frame rate, or with None as
+# often as it can; either way a frame it has already processed isn't published
+# again
+class VisionPipeline():
+    def __init__(self, processor, rate=24):
+        self.__processor = processor
+        self.__period = None if rate is None else 1.0 / rate
+        self.__state = LatestValue()
+        self.__detections = LatestValue()
+        self.__running = False
+        self.__thread = None
+    
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+    
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+    
+    # a copy of auv_state is taken, so the caller can keep updating it
+    def update_state(self, auv_state):
+        self.__state.put(dict(auv_state))
+    
+    # ((red, green), capture time, seq) of the latest detections
+    def get_detections(self):
+        return self.__detections.get()
+    
+    def __run(self):
+        next_time = time.monotonic()
+        last_capture = None
+        while self.__running:
+            if self.__period is not None:
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time = max(next_time + self.__period, time.monotonic())
+            
+            auv_state, _, seq = self.__state.get()
+            if seq == 0 or auv_state['heading'] is None:
+                # nothing to look from yet
+                time.sleep(0.01)
+                continue
+            
+            try:
+                red, green = self.__processor.run(auv_state)
+            except:
+                traceback.print_exc()
+                time.sleep(0.1)
+                continue
+            
+            capture_time = self.__processor.get_frame_time()
+            if self.__processor.get_frame_age() is None:
+                # no frame yet
+                time.sleep(0.01)
+                continue
+            if capture_time == last_capture:
+                # no new frame since the last pass
+                if self.__period is None:
+                    time.sleep(0.005)
+                continue
+            last_capture = capture_time
+            self.__detections.put((red, green), capture_time)
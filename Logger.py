@@ -1,5 +1,16 @@
 import numpy as np
 import datetime
+import pathlib
+import queue
+import threading
+import traceback
+
+import cv2
+
+# read back a log_auv_location file as a (T,4) array of
+# time (ms since start), x, y, heading
+def read_auv_locations(filename):
+    return np.loadtxt(filename, delimiter=',', ndmin=2)
 
 class Logger():
     def __init__(self, print_events=False):
@@ -22,3 +33,188 @@ class Logger():
             arr = np.array([[float_time, x, y, heading]])
             np.savetxt(f, arr, delimiter=',')
 
+
+
+# writes camera frames to JPEG files on a background thread, so encoding and
+# disk I/O never hold up the caller. When the writer falls behind, the oldest
+# queued frame is dropped.
+class FrameLogger():
+    def __init__(self, image_dir, queue_size=8, quality=95, every=1):
+        self.__image_dir = pathlib.Path(image_dir)
+        self.__image_dir.mkdir(parents=True, exist_ok=True)
+        self.__quality = int(quality)
+        # keep every Nth frame offered
+        self.__every = max(int(every), 1)
+        
+        self.__frame_count = 0
+        self.__written = 0
+        self.__dropped = 0
+        self.__lock = threading.Lock()
+        
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__writer = threading.Thread(target=self.__run, daemon=True)
+        self.__writer.start()
+        
+    # queue a copy of image for writing; returns False if it was decimated
+    def log_frame(self, image, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow().timestamp()
+        
+        index = self.__frame_count
+        self.__frame_count += 1
+        if index % self.__every != 0:
+            return False
+        
+        # frame number first, so names are unique and sort in capture order
+        fn = self.__image_dir / f"frame_{index:07d}_{int(timestamp*1000)}.jpg"
+        item = (fn, np.array(image, dtype=np.uint8, copy=True))
+        while True:
+            try:
+                self.__queue.put_nowait(item)
+                return True
+            except queue.Full:
+                try:
+                    _ = self.__queue.get_nowait() # dump the oldest frame
+                    self.__queue.task_done()
+                    with self.__lock:
+                        self.__dropped += 1
+                except queue.Empty:
+                    pass
+    
+    # wait for the queued frames to be written, then stop the writer
+    def close(self):
+        if self.__writer.is_alive():
+            self.__queue.put(None)
+            self.__writer.join()
+    
+    def get_stats(self):
+        with self.__lock:
+            return {'frames': self.__frame_count,
+                    'written': self.__written,
+                    'dropped': self.__dropped,
+                    'queued': self.__queue.qsize()}
+    
+    def __run(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.__quality]
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                self.__queue.task_done()
+                break
+            
+            fn, image = item
+            try:
+                cv2.imwrite(str(fn), image, params)
+                with self.__lock:
+                    self.__written += 1
+            except:
+                traceback.print_exc()
+            self.__queue.task_done()
+
+
+# per-frame entries of a FrameRecorder index; seq is -1 for unused slots
+FRAME_INDEX_DTYPE = np.dtype([('seq', np.int64),
+                              ('time', np.float64),
+                              ('x', np.float64),
+                              ('y', np.float64),
+                              ('heading', np.float64)])
+
+def _recording_files(filename):
+    base = pathlib.Path(filename)
+    return (base.with_name(base.name + '.frames.npy'),
+            base.with_name(base.name + '.index.npy'))
+
+# records raw frames into a preallocated, memory-mapped ring buffer holding
+# the latest capacity frames. filename is the base name of two .npy files:
+# <filename>.frames.npy with the frames and <filename>.index.npy with the
+# sequence number, time and pose of each slot
+class FrameRecorder():
+    def __init__(self, filename, capacity=1000, frame_shape=(480, 640, 3)):
+        self.__capacity = int(capacity)
+        frames_fn, index_fn = _recording_files(filename)
+        frames_fn.parent.mkdir(parents=True, exist_ok=True)
+        
+        self.__frames = np.lib.format.open_memmap(str(frames_fn),
+                                                  mode='w+',
+                                                  dtype=np.uint8,
+                                                  shape=(self.__capacity,) + tuple(frame_shape))
+        self.__index = np.lib.format.open_memmap(str(index_fn),
+                                                 mode='w+',
+                                                 dtype=FRAME_INDEX_DTYPE,
+                                                 shape=(self.__capacity,))
+        self.__index['seq'] = -1
+        self.__seq = 0
+    
+    def get_capacity(self):
+        return self.__capacity
+    
+    # number of frames recorded so far, including those overwritten
+    def get_count(self):
+        return self.__seq
+    
+    def record(self, image, timestamp=None, position=(None, None), heading=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow().timestamp()
+        
+        slot = self.__seq % self.__capacity
+        # invalidate the slot while it's being overwritten
+        self.__index['seq'][slot] = -1
+        np.copyto(self.__frames[slot], image, casting='unsafe')
+        self.__index[slot] = (self.__seq,
+                              timestamp,
+                              np.nan if position[0] is None else position[0],
+                              np.nan if position[1] is None else position[1],
+                              np.nan if heading is None else heading)
+        self.__seq += 1
+    
+    def flush(self):
+        self.__frames.flush()
+        self.__index.flush()
+    
+    def close(self):
+        self.flush()
+        del self.__frames
+        del self.__index
+
+
+# random access to a FrameRecorder recording, oldest frame first. Frames are
+# read from the memory map as they are used, not loaded up front
+class FrameRecording():
+    def __init__(self, filename):
+        frames_fn, index_fn = _recording_files(filename)
+        self.__frames = np.load(str(frames_fn), mmap_mode='r')
+        index = np.load(str(index_fn))
+        
+        # slots in recording order
+        valid = np.flatnonzero(index['seq'] >= 0)
+        self.__slots = valid[np.argsort(index['seq'][valid], kind='stable')]
+        self.__index = index[self.__slots]
+        self.__times = self.__index['time']
+    
+    def __len__(self):
+        return self.__slots.size
+    
+    def __getitem__(self, i):
+        return self.get_frame(i)
+    
+    # seq, time, x, y, heading of every frame
+    def get_index(self):
+        return self.__index
+    
+    def get_times(self):
+        return self.__times
+    
+    def get_frame(self, i):
+        return self.__frames[self.__slots[i]]
+    
+    # position in the recording of the frame closest to time t
+    def find_time(self, t):
+        i = np.searchsorted(self.__times, t)
+        if i == 0:
+            return 0
+        if i == len(self.__times):
+            return i - 1
+        return i if self.__times[i] - t < t - self.__times[i-1] else i - 1
+    
+    def get_frame_at_time(self, t):
+        return self.get_frame(self.find_time(t))
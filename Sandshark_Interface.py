@@ -7,20 +7,189 @@ Created on Fri Jul 16 23:04:06 2021
 """
 
 import time
+import random
 #import sys, os
 
 import socket
 import select
-#import threading
+import threading
 import queue
+import asyncio
 
 import traceback
 
-#import numpy as np
+import numpy as np
 
 #from pynmea2 import pynmea2
 #import BluefinMessages
 
+# splits a byte stream into NMEA sentences, across any chunk boundaries.
+# feed() takes the next chunk and returns the sentences it completes, as bytes
+# from the '$' up to, but not including, the '\r\n' (or '\n'). Anything before
+# the last '$' of a line is noise (e.g. the tail of a sentence cut short) and
+# is dropped, as is a sentence longer than max_length; either way the result
+# doesn't depend on how the stream was chunked. Lines are found in place in one
+# bytearray, with each sentence copied out once, and no more than about
+# max_length bytes of a line are held while waiting for its end.
+class NMEAFramer():
+    def __init__(self, max_length=1024):
+        self.__buffer = bytearray()
+        self.__max_length = max_length
+        self.__dropped = 0
+        # part of the line being held was already thrown away
+        self.__noisy = False
+    
+    def feed(self, data):
+        buf = self.__buffer
+        buf += data
+        
+        sentences = list()
+        start = 0
+        view = memoryview(buf)
+        try:
+            while True:
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    break
+                line_end = end
+                if line_end > start and buf[line_end-1] == 0x0d:
+                    line_end -= 1
+                
+                first = buf.rfind(b'$', start, line_end)
+                if first < 0:
+                    if line_end > start or self.__noisy:
+                        self.__dropped += 1
+                elif line_end - first > self.__max_length:
+                    self.__dropped += 1
+                else:
+                    if first > start or self.__noisy:
+                        self.__dropped += 1
+                    sentences.append(bytes(view[first:line_end]))
+                self.__noisy = False
+                start = end + 1
+            
+            # only the partial line from its last '$' can still be a sentence;
+            # it may yet be followed by its '\r'
+            first = buf.rfind(b'$', start)
+            if first < 0:
+                first = len(buf)
+            if first > start:
+                self.__noisy = True
+                start = first
+            if len(buf) - start > self.__max_length + 1:
+                # too long, unless another '$' comes along
+                self.__noisy = True
+                start = len(buf)
+        finally:
+            view.release()
+        
+        # keep the partial sentence for the next chunk
+        del buf[:start]
+        return sentences
+    
+    # bytes waiting for the end of their sentence
+    def pending(self):
+        return len(self.__buffer)
+    
+    # number of lines or partial sentences thrown away as noise
+    def get_dropped(self):
+        return self.__dropped
+    
+    def reset(self):
+        self.__buffer.clear()
+        self.__noisy = False
+
+
+# timing of the messages a client receives, kept per sentence type ('$BFNVG',
+# ...) for the last history messages of each:
+#   latency    - end to end, from the time stamped in the sentence (hhmmss.ss
+#                UTC, the first field of the timed sentence types) to the
+#                sentence being read off the socket, by this machine's clock,
+#                so up to 10 ms late from the stamp's resolution. Only
+#                meaningful with the clocks in sync, e.g. against the
+#                simulated front seat at warp 1
+#   queue_wait - from being read off the socket to being picked up by
+#                receive_mail, i.e. how often the mail is collected
+class MailLatency():
+    def __init__(self, history=1000, timed=('$BFNVG',)):
+        self.__history = history
+        self.__timed = set(timed)
+        self.__types = dict()
+        self.__lock = threading.Lock()
+    
+    # msg was read off the socket at now (time.time())
+    def received(self, msg, now=None):
+        if now is None:
+            now = time.time()
+        kind = self.__kind(msg)
+        if kind not in self.__timed:
+            return
+        sent = _sentence_time(msg)
+        if sent is None:
+            return
+        # seconds since midnight UTC, wrapped so a sentence stamped just
+        # before midnight and read just after is a little late, not a day
+        latency = (now % 86400.0 - sent + 43200.0) % 86400.0 - 43200.0
+        with self.__lock:
+            self.__add(self.__entry(kind), 'latency', latency)
+    
+    # msg was read off the socket at received (time.monotonic())
+    def delivered(self, msg, received, now=None):
+        if now is None:
+            now = time.monotonic()
+        kind = self.__kind(msg)
+        with self.__lock:
+            entry = self.__entry(kind)
+            entry['count'] += 1
+            self.__add(entry, 'queue_wait', now - received)
+    
+    # per sentence type: messages picked up, and the mean, 99th percentile
+    # and max of the latency and queue wait, in seconds (None where there
+    # are none, e.g. the latency of untimed sentences)
+    def get_stats(self):
+        stats = dict()
+        with self.__lock:
+            for kind, entry in self.__types.items():
+                stats[kind] = {'count': entry['count']}
+                for name in ('latency', 'queue_wait'):
+                    n = min(entry[name + '_count'], self.__history)
+                    values = entry[name][:n]
+                    stats[kind][name + '_mean'] = float(np.mean(values)) if n > 0 else None
+                    stats[kind][name + '_p99'] = float(np.percentile(values, 99)) if n > 0 else None
+                    stats[kind][name + '_max'] = float(np.max(values)) if n > 0 else None
+        return stats
+    
+    def __kind(self, msg):
+        return str(bytes(msg.split(b',', 1)[0]), 'utf-8', 'replace')
+    
+    def __entry(self, kind):
+        if kind not in self.__types:
+            self.__types[kind] = {'count': 0,
+                                  'latency': np.zeros(self.__history),
+                                  'latency_count': 0,
+                                  'queue_wait': np.zeros(self.__history),
+                                  'queue_wait_count': 0}
+        return self.__types[kind]
+    
+    def __add(self, entry, name, value):
+        entry[name][entry[name + '_count'] % self.__history] = value
+        entry[name + '_count'] += 1
+
+# seconds since midnight from the hhmmss.ss first field of a sentence, None
+# if it doesn't have one
+def _sentence_time(msg):
+    fields = bytes(msg).split(b',', 2)
+    if len(fields) < 2:
+        return None
+    stamp = fields[1].split(b'*', 1)[0]
+    try:
+        if len(stamp) < 6 or not stamp[:6].isdigit():
+            return None
+        return int(stamp[0:2]) * 3600 + int(stamp[2:4]) * 60 + float(stamp[4:])
+    except ValueError:
+        return None
+
+
 ## The main message handler
 class SandsharkServer():
     def __init__(self,
@@ -44,6 +213,8 @@ class SandsharkServer():
         try:
             inputs = [ self.__sockt ]
             outputs = [ ]
+            # each connection's partial sentence
+            framers = dict()
             
             while inputs:
                 try:
@@ -74,10 +245,12 @@ class SandsharkServer():
                         #print(f"New connection from {client_address}")
                         connection.setblocking(0)
                         inputs.append(connection)
+                        framers[connection] = NMEAFramer()
                     else:
                         data = s.recv(self.__PACKET_SIZE)
                         if data:
-                            self.__incoming.put(data)
+                            for msg in framers[s].feed(data):
+                                _put_drop_oldest(self.__incoming, msg)
                             #print(f"Received: {str(data, 'UTF-8')}")
                             if s not in outputs:
                                 # use this open connection to send data
@@ -86,6 +259,7 @@ class SandsharkServer():
                             if s in outputs:
                                 outputs.remove(s)
                             inputs.remove(s)
+                            framers.pop(s, None)
                             s.close()
                 for s in writeable:
                     while not self.__outgoing.empty():
@@ -169,44 +343,34 @@ class SandsharkClient():
                 print("waiting to connect to front seat...")
                 time.sleep(1)
         self.__outgoing = queue.Queue(maxsize=10)
+        # (time read off the socket, sentence)
         self.__incoming = queue.Queue(maxsize=50)
+        self.__latency = MailLatency()
+        self.__running = False
         
+    # sends from this thread; a reader thread drains the socket as data
+    # arrives, rather than only after each send
     def run(self):
+        self.__running = True
+        reader = threading.Thread(target=self.__receive_loop, daemon=True)
+        reader.start()
         try:
-            remain = b''
-            while True:
-                if not self.__outgoing.empty():
-                    next_msg = self.__outgoing.get()
-                    try:
-                        self.__sockt.connect((self.__host, self.__port))
-                    except:
-                        pass
-                    self.__sockt.send(next_msg)
-                    self.__outgoing.task_done()
-    
-                    #time.sleep(0.01)
-                    
-                    # now check for messages in return
-                    data = self.__sockt.recv(self.__PACKET_SIZE)
-                    #msgs = list()
-                    if data:
-                        data = remain + data
-                        msgs = data.split(b'\n')
-                        #print(f"msgs = {msgs}")
-                        # check if msgs[-1] is complete
-                        if len(msgs[-1])<10 or (msgs[-1][-1] != '\r' and msgs[-1][-3] != '*'):
-                            remain = msgs[-1]
-                            msgs = msgs[:-1]
-                            #print(f"remain = {remain}")
-                            #print(f"msgs2 = {msgs}")
-                            
-                        for msg in msgs:
-                            self.__incoming.put(msg)
-                        
-                time.sleep(0.01)
+            while self.__running:
+                try:
+                    next_msg = self.__outgoing.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                try:
+                    self.__sockt.connect((self.__host, self.__port))
+                except:
+                    pass
+                self.__sockt.send(next_msg)
+                self.__outgoing.task_done()
         except:
-            traceback.print_exc()
+            if self.__running:
+                traceback.print_exc()
             self.cleanup()
+        reader.join()
             
     # send command to the vehicle - try without a worker thread for now
     def send_message(self, cmd):
@@ -219,15 +383,43 @@ class SandsharkClient():
     def receive_mail(self):        
         your_mail = list()
         while not self.__incoming.empty():
-            msg = self.__incoming.get()
+            received, msg = self.__incoming.get()
+            self.__latency.delivered(msg, received)
             your_mail.append(msg)
             self.__incoming.task_done()
             
         return your_mail
 
+    # per sentence type, the end to end latency of timed sentences and how
+    # long messages waited to be picked up by receive_mail (see MailLatency)
+    def get_latency_stats(self):
+        return self.__latency.get_stats()
                     
     def cleanup(self):
+        self.__running = False
+        try:
+            # wakes the reader thread out of recv
+            self.__sockt.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.__sockt.close()
+    
+    def __receive_loop(self):
+        framer = NMEAFramer()
+        try:
+            while self.__running:
+                data = self.__sockt.recv(self.__PACKET_SIZE)
+                if not data:
+                    break
+                now = time.monotonic()
+                wall = time.time()
+                for msg in framer.feed(data):
+                    self.__latency.received(msg, wall)
+                    _put_drop_oldest(self.__incoming, (now, msg))
+        except OSError:
+            # the socket was closed by cleanup
+            if self.__running:
+                traceback.print_exc()
             
     def __listener_thread(self, client):
         done = False
@@ -249,9 +441,300 @@ class SandsharkClient():
         print(f"Received {data}")
         #nmea.parse(data)        
         
+# put item on a bounded queue.Queue, dropping the oldest item if it's full
+def _put_drop_oldest(q, item):
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                _ = q.get_nowait() # dump message
+                q.task_done()
+            except queue.Empty:
+                pass
+
+
+## asyncio transports: the same interface as SandsharkServer/SandsharkClient,
+## but reads and writes are driven by socket events on an asyncio loop instead
+## of polling. run() runs the loop until cleanup() is called (from any
+## thread); serve() is the coroutine behind it, to share one loop among many
+## transports
+
+# what the asyncio server and client share: the queues to and from the
+# caller's thread, the loop and its events, and reading sentences off a
+# stream. Subclasses implement _serve, and may override _received and
+# _delivered to change what goes on the incoming queue
+class _AsyncTransport():
+    def __init__(self, host, port, PACKET_SIZE):
+        self._host = host
+        self._port = port
+        self._PACKET_SIZE = PACKET_SIZE
+        
+        self._outgoing = queue.Queue(maxsize=10)
+        self._incoming = queue.Queue(maxsize=50)
+        
+        # set up on the loop by serve()
+        self._loop = None
+        self._wake = None
+        self._stop = None
+        
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except:
+            traceback.print_exc()
+    
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        await self._serve()
+    
+    # pick up whatever messages have been accumulated since last request
+    def receive_mail(self):
+        your_mail = list()
+        while not self._incoming.empty():
+            your_mail.append(self._delivered(self._incoming.get()))
+            self._incoming.task_done()
+            
+        return your_mail
+    
+    def cleanup(self):
+        self._notify(self._stop)
+    
+    async def _serve(self):
+        raise NotImplementedError
+    
+    # queue a message, to be sent from the loop
+    def _send(self, cmd):
+        _put_drop_oldest(self._outgoing, bytes(cmd, 'utf-8'))
+        self._notify(self._wake)
+    
+    # set an event on the loop from any thread
+    def _notify(self, event):
+        loop = self._loop
+        if loop is not None and event is not None:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the loop has closed
+                pass
+    
+    # until the other end hangs up
+    async def _receive_loop(self, reader):
+        framer = NMEAFramer()
+        while True:
+            data = await reader.read(self._PACKET_SIZE)
+            if not data:
+                break
+            self._received(framer.feed(data))
+    
+    # sentences just read off a stream
+    def _received(self, msgs):
+        for msg in msgs:
+            _put_drop_oldest(self._incoming, msg)
+    
+    # the message receive_mail returns for an item off the incoming queue
+    def _delivered(self, item):
+        return item
+
+
+class AsyncSandsharkServer(_AsyncTransport):
+    def __init__(self,
+                 host="",
+                 port=8000,
+                 PACKET_SIZE=1024):
+        super().__init__(host, port, PACKET_SIZE)
+        
+        self.__writers = set()
+        self.__handlers = set()
+    
+    # send message to the payload
+    def send_command(self, cmd):
+        self._send(cmd)
+    
+    async def _serve(self):
+        server = await asyncio.start_server(self.__handle_client,
+                                            self._host,
+                                            self._port)
+        sender = asyncio.create_task(self.__send_loop())
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            sender.cancel()
+            # hang up, and let the connection handlers see the end of input
+            for writer in list(self.__writers):
+                writer.close()
+            await asyncio.gather(*self.__handlers, return_exceptions=True)
+    
+    async def __handle_client(self, reader, writer):
+        self.__handlers.add(asyncio.current_task())
+        self.__writers.add(writer)
+        # send anything that was waiting for a connection
+        self._wake.set()
+        try:
+            await self._receive_loop(reader)
+        except ConnectionError:
+            traceback.print_exc()
+        finally:
+            self.__writers.discard(writer)
+            self.__handlers.discard(asyncio.current_task())
+            writer.close()
+    
+    # messages wait in the queue until there's a connection to send them on
+    async def __send_loop(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            writers = list(self.__writers)
+            if len(writers) == 0:
+                continue
+            
+            while not self._outgoing.empty():
+                next_msg = self._outgoing.get()
+                print(f"To Backseat: {str(next_msg, 'utf-8')}\n")
+                for writer in writers:
+                    writer.write(next_msg)
+                self._outgoing.task_done()
+            
+            for writer in writers:
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    self.__writers.discard(writer)
+
+
+class AsyncSandsharkClient(_AsyncTransport):
+    def __init__(self,
+                 host="localhost",
+                 port=8000,
+                 PACKET_SIZE=1024):
+        # the incoming queue holds (time read off the socket, sentence)
+        super().__init__(host, port, PACKET_SIZE)
+        
+        self.__latency = MailLatency()
+    
+    # send command to the vehicle
+    def send_message(self, cmd):
+        self._send(cmd)
+    
+    # as SandsharkClient.get_latency_stats
+    def get_latency_stats(self):
+        return self.__latency.get_stats()
+    
+    async def _serve(self):
+        # send anything queued before the loop started
+        self._wake.set()
+        
+        # unlike SandsharkClient, connect here rather than on construction
+        writer = None
+        while writer is None and not self._stop.is_set():
+            try:
+                reader, writer = await asyncio.open_connection(self._host, self._port)
+            except OSError:
+                print("waiting to connect to front seat...")
+                try:
+                    await asyncio.wait_for(self._stop.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+        if writer is None:
+            return
+        
+        tasks = [asyncio.create_task(self._receive_loop(reader)),
+                 asyncio.create_task(self.__send_loop(writer)),
+                 asyncio.create_task(self._stop.wait())]
+        try:
+            # until the front seat hangs up or we're stopped
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+    
+    def _received(self, msgs):
+        now = time.monotonic()
+        wall = time.time()
+        for msg in msgs:
+            self.__latency.received(msg, wall)
+            _put_drop_oldest(self._incoming, (now, msg))
+    
+    def _delivered(self, item):
+        received, msg = item
+        self.__latency.delivered(msg, received)
+        return msg
+    
+    async def __send_loop(self, writer):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while not self._outgoing.empty():
+                next_msg = self._outgoing.get()
+                writer.write(next_msg)
+                self._outgoing.task_done()
+            await writer.drain()
+
+
+# fuzz test of NMEAFramer: a stream of clean sentences, sentences after
+# noise, lines with a '$' inside, overlong sentences and noise lines, ended
+# with '\r\n' or '\n', is fed in random chunks, and must come out as exactly
+# the sentences expected however it's chunked
+def test_framer(trials=2000, max_length=64, seed=0):
+    rnd = random.Random(seed)
+    
+    def sentence(length):
+        body = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,-')
+                       for _ in range(length - 4))
+        return bytes(f"${body}*{rnd.randrange(256):02X}", 'ascii')
+    
+    def noise():
+        return bytes(''.join(rnd.choice('abc xyz0123,*') for _ in range(rnd.randint(1, 20))), 'ascii')
+    
+    for trial in range(trials):
+        stream = bytearray()
+        expected = list()
+        dropped = 0
+        for _ in range(rnd.randint(0, 30)):
+            kind = rnd.choice(('clean', 'noise_first', 'inner_dollar', 'overlong', 'noise'))
+            msg = sentence(rnd.randint(5, max_length))
+            if kind == 'clean':
+                line = msg
+                expected.append(msg)
+            elif kind == 'noise_first':
+                line = noise() + msg
+                expected.append(msg)
+                dropped += 1
+            elif kind == 'inner_dollar':
+                # a sentence cut short by the next one
+                line = sentence(rnd.randint(5, 2*max_length))[:-rnd.randint(1, 4)] + msg
+                expected.append(msg)
+                dropped += 1
+            elif kind == 'overlong':
+                line = noise()[:rnd.randint(0, 1)] + sentence(rnd.randint(max_length + 1, 4*max_length))
+                dropped += 1
+            else:
+                line = noise()
+                dropped += 1
+            stream += line + rnd.choice((b'\r\n', b'\n'))
+        
+        framer = NMEAFramer(max_length=max_length)
+        received = list()
+        pos = 0
+        while pos < len(stream):
+            size = rnd.choice((1, 2, 3, 7, rnd.randint(1, 2*max_length), 1024))
+            received += framer.feed(bytes(stream[pos:pos+size]))
+            pos += size
+        
+        assert received == expected, f"trial {trial}: {received} != {expected}"
+        assert framer.pending() == 0, f"trial {trial}: {framer.pending()} bytes left"
+        assert framer.get_dropped() == dropped, f"trial {trial}: dropped {framer.get_dropped()} != {dropped}"
+    print(f"NMEAFramer: {trials} random chunkings OK")
+
+
 # for unit test
 def main():
-    pass                        
+    test_framer()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
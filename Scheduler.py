@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed-rate scheduling of periodic tasks on one thread.
+
+Each task has a rate in Hz and runs on deadlines at whole periods from the
+start of the schedule, so its rate doesn't drift with how long the tasks take.
+A task that hasn't finished by its next deadline, whether it ran long or was
+held up by other tasks, has overrun and runs again as soon as it can; any
+further deadlines it missed are skipped rather than run back to back. For each
+task the scheduler keeps the jitter (how late it started relative to its
+deadline) and its run time.
+
+@author: BWSI AUV Challenge Instructional Staff
+"""
+import time
+
+import numpy as np
+
+
+class RateScheduler():
+    def __init__(self, history=1000):
+        self.__tasks = list()
+        # jitter and run time are kept for the last history runs of each task
+        self.__history = history
+        self.__start = None
+
+    # tasks due at the same time run in the order they were added
+    def add_task(self, name, func, rate):
+        if rate <= 0:
+            raise ValueError(f"Task {name} needs a positive rate, not {rate}")
+        self.__tasks.append({'name': name,
+                             'func': func,
+                             'period': 1.0 / rate,
+                             'next': None,
+                             'runs': 0,
+                             'overruns': 0,
+                             'skipped': 0,
+                             'jitter': np.zeros(self.__history),
+                             'duration': np.zeros(self.__history)})
+
+    def set_rate(self, name, rate):
+        if rate <= 0:
+            raise ValueError(f"Task {name} needs a positive rate, not {rate}")
+        self.__task(name)['period'] = 1.0 / rate
+
+    # run tasks as they come due, until duration seconds have passed or
+    # stop() returns True (checked after each task)
+    def run(self, duration=None, stop=None):
+        now = time.monotonic()
+        if self.__start is None:
+            self.__start = now
+            for task in self.__tasks:
+                task['next'] = now
+        end = None if duration is None else now + duration
+
+        while len(self.__tasks) > 0:
+            task = min(self.__tasks, key=lambda t: t['next'])
+            due = task['next']
+            if end is not None and due > end:
+                break
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            started = time.monotonic()
+            task['func']()
+            finished = time.monotonic()
+            self.__account(task, due, started, finished)
+
+            if stop is not None and stop():
+                break
+
+    # per task: runs, overruns, skipped deadlines, and the mean, 99th
+    # percentile and max of the jitter and run time, in seconds
+    def get_stats(self):
+        stats = dict()
+        for task in self.__tasks:
+            n = min(task['runs'], self.__history)
+            jitter = task['jitter'][:n] if n > 0 else np.zeros(1)
+            duration = task['duration'][:n] if n > 0 else np.zeros(1)
+            stats[task['name']] = {'rate': 1.0 / task['period'],
+                                   'runs': task['runs'],
+                                   'overruns': task['overruns'],
+                                   'skipped': task['skipped'],
+                                   'jitter_mean': float(np.mean(jitter)),
+                                   'jitter_p99': float(np.percentile(jitter, 99)),
+                                   'jitter_max': float(np.max(jitter)),
+                                   'duration_mean': float(np.mean(duration)),
+                                   'duration_p99': float(np.percentile(duration, 99)),
+                                   'duration_max': float(np.max(duration))}
+        return stats
+
+    # one line per task, for logs
+    def report(self):
+        lines = list()
+        for name, s in self.get_stats().items():
+            lines.append(f"{name}: {s['rate']:.1f} Hz, {s['runs']} runs, "
+                         f"{s['overruns']} overruns, {s['skipped']} skipped, "
+                         f"jitter mean/p99/max {s['jitter_mean']*1e3:.1f}/"
+                         f"{s['jitter_p99']*1e3:.1f}/{s['jitter_max']*1e3:.1f} ms, "
+                         f"run time mean/max {s['duration_mean']*1e3:.1f}/"
+                         f"{s['duration_max']*1e3:.1f} ms")
+        return '\n'.join(lines)
+
+    def __task(self, name):
+        for task in self.__tasks:
+            if task['name'] == name:
+                return task
+        raise KeyError(name)
+
+    def __account(self, task, due, started, finished):
+        slot = task['runs'] % self.__history
+        task['jitter'][slot] = started - due
+        task['duration'][slot] = finished - started
+        task['runs'] += 1
+
+        period = task['period']
+        next_due = due + period
+        if finished > next_due:
+            task['overruns'] += 1
+            # run late for the latest deadline that has passed, skipping any
+            # before it, so the task keeps to the same phase
+            missed = int((finished - next_due) // period)
+            task['skipped'] += missed
+            next_due += missed * period
+        task['next'] = next_due